@@ -46,14 +46,24 @@ class Accessor(object):
     Accessors provide an object oriented interface for a specific 
     entity instance (guid) by providing an object with attributes
     that access the array slices allocated to that guid under
-    the hood.'''
+    the hood.
+
+    Views of the guid's rows are cached until the allocator's
+    layout_generation changes.  The allocator only holds Accessors weakly.
+
+    Reading an attribute does not mark rows dirty.  Assigning does, and so
+    do augmented assignments like `hero.position += v`, which assign the
+    view back.  After writing into a view by index (`hero.position[0] = 1`)
+    call mark_dirty('position').'''
+
+    __slots__ = ('_guid','_generation','_references','_views','__weakref__')
 
     def __init__(self,guid):
       # self._allocator is provided by the factory
       self._guid = guid
-      self._dirty  = True #do slices need to be re-calculated?
-      self._active = True #is this accessor deleteable?
+      self._generation = None #allocator layout_generation the views are from
       self._references = {} #{component_name:slice,...}
+      self._views = {} #{component_name:component[slice],...}
       #The factory gave us a property for every component in the Table
       # but any specific guid won't have values for all of those
       # so we delete them
@@ -65,11 +75,14 @@ class Accessor(object):
       #        delattr(self,name)
 
     def _rebuild_references(self,build_ref = build_references):
-        '''Get the up to date slices for all the attributes'''
+        '''Get the up to date slices and views for all the attributes'''
         # the is not None is not necessary, but not harmful
-        self._references = {k:v for k,v in build_ref(self._allocator,
+        allocator = self._allocator
+        self._references = {k:v for k,v in build_ref(allocator,
             self._guid).items() if v is not None}
-        self._dirty = False
+        comp_dict = allocator.component_dict
+        self._views = {k:comp_dict[k][v] for k,v in self._references.items()}
+        self._generation = allocator.layout_generation
 
     #def resize(self,new_size):
     #    self._domain.safe_realloc(self._id,new_size)
@@ -82,6 +95,13 @@ class Accessor(object):
     #    if not self.__closed:
     #      self.close()
 
+    def mark_dirty(self,name):
+        '''record that this guid's rows of Component name were written
+        through a view'''
+        if self._generation != self._allocator.layout_generation:
+            self._rebuild_references()
+        self._allocator.component_dict[name].mark_dirty(self._references[name])
+
     def __repr__(self):
       return "<Accessor for guid #%s>"%(self._guid,)
 
@@ -93,30 +113,29 @@ class AccessorFactory(object):
 
     def attribute_getter_factory(self, component_name):
           '''generate a getter for this component_name into the Component data array'''
-          comp_dict = self.allocator.component_dict
-          def getter(accessor, name=component_name, comp_dict=comp_dict):
-            if accessor._dirty:
+          allocator = self.allocator
+          def getter(accessor, name=component_name):
+            if accessor._generation != allocator.layout_generation:
                 accessor._rebuild_references()
-            selector = accessor._references[name]
-            return comp_dict[name][selector]
+            return accessor._views[name]
           return getter
 
     def attribute_setter_factory(self, component_name):
           '''generate a setter using this object's index to the domain arrays
           attr is the domain's list of this attribute'''
-          comp_dict = self.allocator.component_dict
-          def setter(accessor, data, name=component_name,comp_dict=comp_dict):
-            if accessor._dirty:
+          allocator = self.allocator
+          component = allocator.component_dict[component_name]
+          def setter(accessor, data, name=component_name, component=component):
+            if accessor._generation != allocator.layout_generation:
                 accessor._rebuild_references()
-            selector = accessor._references[name]
-            comp_dict[name][selector] = data
+            component[accessor._references[name]] = data
           return setter
 
     def generate_accessor(self):
         '''return a DataAccessor class that can be instatiated with a
         guid to provide an object oriented interface with the data 
         associated with that guid'''
-        NewAccessor = type('DataAccessor',(Accessor,),{})
+        NewAccessor = type('DataAccessor',(Accessor,),{'__slots__':()})
 
         allocator = self.allocator
         getter = self.attribute_getter_factory
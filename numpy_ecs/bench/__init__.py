@@ -0,0 +1,339 @@
+'''
+Headless benchmarks of the allocator, defrag, queries and Systems.
+
+Each scenario builds a world of n polygons like those in examples/add-delete.py
+(untimed), then times one operation on it.  Run the suite with
+
+    python -m numpy_ecs.bench --sizes 1e3 1e4 1e5
+
+which prints a JSON report with time, throughput and peak memory of every
+scenario at every size.
+
+This file is part of Numpy-ECS.
+Copyright (C) 2016 Elliot Hallmark (permafacture@gmail.com)
+
+Numpy-ECS is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 2 of the License, or
+(at your option) any later version.
+
+Data Oriented Python is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+from __future__ import absolute_import, division, print_function
+import sys
+#python version compatability
+if sys.version_info < (3,0):
+    from future_builtins import zip, map
+
+import os
+import gc
+import time
+import subprocess
+import platform
+from collections import OrderedDict
+import numpy as np
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+try:
+    import resource
+except ImportError:
+    resource = None
+
+from ..global_allocator import GlobalAllocator
+from ..components import DefraggingArrayComponent as Component
+from .. import kernels
+
+timer = getattr(time,'perf_counter',time.time)
+
+DEFAULT_SIZES = (1000,10000) #churn takes minutes at 1e5 (Table.compress)
+CHURN_ROUNDS = 10
+CHURN_FRACTION = .05 #of the world deleted and re-added each round
+FRAMES = 10
+
+counter_type = np.dtype([('max_val',    np.float32),
+                         ('min_val',    np.float32),
+                         ('interval',   np.float32),
+                         ('accumulator',np.float32)])
+
+#########
+#
+#  Worlds
+#
+#########
+
+def make_allocator():
+    return GlobalAllocator((Component('render_verts', (3,), np.float32  ),
+                            Component('poly_verts'  , (5,), np.float32  ),
+                            Component('color'       , (3,), np.float32  ),
+                            Component('position'    , (3,), np.float32  ),
+                            Component('rotator'     , (1,), counter_type)),
+                           allocation_scheme = ((1,0,1,1,0),
+                                                (1,1,1,1,1)))
+
+def make_polygons(n,rng):
+    '''n dicts for allocator.add.  Three quarters rotate, with 4 to 8
+    vertices each.'''
+    polygons = []
+    for sides, rotates, pos in zip(rng.randint(4,9,n), rng.random_sample(n) < .75,
+                                   rng.random_sample((n,3)).astype(np.float32)):
+        polygon = {'render_verts': np.zeros((sides,3),dtype=np.float32),
+                   'color'       : np.full((sides,3),.5,dtype=np.float32),
+                   'position'    : pos}
+        if rotates:
+            polygon['poly_verts'] = rng.random_sample((sides,5)).astype(np.float32)
+            polygon['rotator'] = (4*np.pi,-4*np.pi,rng.random_sample()-.5,0)
+        polygons.append(polygon)
+    return polygons
+
+def make_world(n,rng):
+    '''allocator holding n polygons, defragged'''
+    allocator = make_allocator()
+    for polygon in make_polygons(n,rng):
+        allocator.add(polygon)
+    allocator._defrag()
+    return allocator
+
+#########
+#
+#  Scenarios
+#
+#########
+
+def setup_spawn(n,rng):
+    return make_allocator(), make_polygons(n,rng)
+
+def spawn(state):
+    allocator, polygons = state
+    for polygon in polygons:
+        allocator.add(polygon)
+    allocator._defrag()
+    return len(polygons)
+
+def setup_spawn_prefab(n,rng):
+    allocator = make_allocator()
+    polygon = make_polygons(1,rng)[0]
+    polygon.setdefault('poly_verts',np.zeros((len(polygon['color']),5)))
+    polygon.setdefault('rotator',(4*np.pi,-4*np.pi,.1,0))
+    allocator.register_prefab('polygon',polygon)
+    return allocator, rng.random_sample((n,3)).astype(np.float32)
+
+def spawn_prefab(state):
+    '''spawn n copies of one polygon at their own positions'''
+    allocator, positions = state
+    allocator.spawn('polygon',len(positions),{'position':positions})
+    allocator._defrag()
+    return len(positions)
+
+def setup_churn(n,rng):
+    return make_world(n,rng), rng
+
+def churn(state):
+    '''delete and re-add CHURN_FRACTION of the world, CHURN_ROUNDS times'''
+    allocator, rng = state
+    count = 0
+    for _ in range(CHURN_ROUNDS):
+        guids = allocator._allocation_table.guids
+        k = max(int(len(guids)*CHURN_FRACTION),1)
+        for i in rng.choice(len(guids),k,replace=False).tolist():
+            allocator.delete(guids[i])
+        for polygon in make_polygons(k,rng):
+            allocator.add(polygon)
+        allocator._defrag()
+        count += 2*k
+    return count
+
+def setup_defrag(n,rng):
+    allocator = make_world(n,rng)
+    guids = list(allocator._allocation_table.guids)
+    for i in rng.choice(len(guids),len(guids)//2,replace=False).tolist():
+        allocator.delete(guids[i])
+    return allocator
+
+def defrag(allocator):
+    '''_defrag after deleting a random half of the world'''
+    n = len(allocator._allocation_table.guids)
+    allocator._defrag()
+    return n
+
+QUERIES = (('rotator',),
+           ('render_verts','poly_verts','position','rotator',
+            'position__to__poly_verts'),
+           ('render_verts','color'))
+
+def query_cold(allocator):
+    '''queries after the layout changed, so nothing is memoized'''
+    for query in QUERIES:
+        allocator._layout_changed()
+        allocator.selectors_from_component_query(query)
+    return len(QUERIES)
+
+def query_cached(allocator):
+    count = 0
+    for _ in range(100):
+        for query in QUERIES:
+            allocator.selectors_from_component_query(query)
+            count += 1
+    return count
+
+def naive_systems(allocator):
+    '''update_rotator and update_render_verts as written in the examples'''
+    sections = allocator.selectors_from_component_query(QUERIES[1])
+    render_verts, poly_verts, positions, rotator, indices = \
+        (sections[name] for name in QUERIES[1])
+    for _ in range(FRAMES):
+        arr = rotator
+        span = arr['max_val'] - arr['min_val']
+        arr['accumulator'] += arr['interval']
+        underflow = arr['accumulator'] <= arr['min_val']
+        arr['accumulator'][underflow] += span[underflow]
+        overflow = arr['accumulator'] >= arr['max_val']
+        arr['accumulator'][overflow] -= span[overflow]
+
+        cos_ts, sin_ts = np.cos(arr['accumulator']), np.sin(arr['accumulator'])
+        cos_ts -= 1
+        xs, ys, rs, xhelpers, yhelpers = (poly_verts[:,x] for x in range(5))
+        pts = render_verts
+        pts[:,0] = xhelpers*cos_ts[indices]
+        pts[:,1] = yhelpers*sin_ts[indices]
+        pts[:,0] -= pts[:,1]
+        pts[:,0] *= rs
+        pts[:,0] += xs
+        pts[:,0] += positions[indices,0]
+        pts[:,1] = yhelpers*cos_ts[indices]
+        tmp = xhelpers*sin_ts[indices]
+        pts[:,1] += tmp
+        pts[:,1] *= rs
+        pts[:,1] += ys
+        pts[:,1] += positions[indices,1]
+    return FRAMES*len(render_verts)
+
+def kernel_systems(allocator):
+    '''the same Systems with numpy_ecs.kernels'''
+    sections = allocator.selectors_from_component_query(QUERIES[1])
+    render_verts, poly_verts, positions, rotator, indices = \
+        (sections[name] for name in QUERIES[1])
+    scratch = kernels.Scratch()
+    for _ in range(FRAMES):
+        kernels.wrap_counter(rotator,QUERIES[1],scratch)
+        kernels.rotate_verts(render_verts,poly_verts,positions,
+                             rotator['accumulator'],indices,QUERIES[1],scratch)
+    return FRAMES*len(render_verts)
+
+DORMANT_FRACTION = .9
+
+def make_dormant_world(n,rng):
+    '''make_world with DORMANT_FRACTION of it deactivated'''
+    allocator = make_world(n,rng)
+    guids = allocator.guids
+    dormant = rng.choice(len(guids),int(len(guids)*DORMANT_FRACTION),replace=False)
+    allocator.deactivate([guids[i] for i in dormant.tolist()])
+    allocator._defrag()
+    return allocator
+
+# name: (setup(n, rng) -> state, run(state) -> items processed, unit)
+SCENARIOS = OrderedDict((
+    ('spawn',          (setup_spawn,  spawn,          'entities')),
+    ('spawn_prefab',   (setup_spawn_prefab, spawn_prefab, 'entities')),
+    ('churn',          (setup_churn,  churn,          'entities')),
+    ('defrag',         (setup_defrag, defrag,         'entities')),
+    ('query_cold',     (make_world,   query_cold,     'queries' )),
+    ('query_cached',   (make_world,   query_cached,   'queries' )),
+    ('naive_systems',  (make_world,   naive_systems,  'vertices')),
+    ('kernel_systems', (make_world,   kernel_systems, 'vertices')),
+    ('dormant_systems',(make_dormant_world, kernel_systems, 'vertices')),
+))
+
+#########
+#
+#  Measuring
+#
+#########
+
+def _peak_rss():
+    '''peak resident memory of this process in bytes, or None'''
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak*1024
+
+def run_once(name,n,seed=0):
+    '''run scenario name at size n and print the peak resident memory of
+    this process.  See _child_peak_rss.'''
+    setup, run, unit = SCENARIOS[name]
+    run(setup(n,np.random.RandomState(seed)))
+    print(_peak_rss())
+
+def _child_peak_rss(name,n,seed):
+    '''peak resident memory of a fresh process running scenario name once,
+    or None.  ru_maxrss never goes down, so measured in this process it
+    would be the peak of every run before.'''
+    if resource is None:
+        return None
+    root = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(p for p in (root,env.get('PYTHONPATH')) if p)
+    code = 'from numpy_ecs.bench import run_once; run_once(%r,%d,%d)'%(name,n,seed)
+    output = subprocess.check_output([sys.executable,'-c',code],env=env)
+    return int(output.split()[-1]) #after the chatter of building allocators
+
+def measure(name,n,repeat=3,seed=0):
+    '''returns a dict of the best time of repeat runs of scenario name at
+    size n, and the peak memory of one more run.  Without tracemalloc
+    (python 2) that run is in a child process and the peak includes the
+    interpreter and the world.'''
+    setup, run, unit = SCENARIOS[name]
+    rng = np.random.RandomState(seed)
+    best = None
+    for _ in range(repeat):
+        state = setup(n,rng)
+        gc.collect()
+        start = timer()
+        items = run(state)
+        seconds = timer() - start
+        best = seconds if best is None else min(best,seconds)
+        del state
+    if tracemalloc is not None:
+        state = setup(n,rng)
+        gc.collect()
+        tracemalloc.start()
+        run(state)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        memory = 'tracemalloc'
+        del state
+    else:
+        peak = _child_peak_rss(name,n,seed)
+        memory = 'maxrss' if peak is not None else None
+    return OrderedDict((('scenario',name),
+                        ('n',n),
+                        ('seconds',best),
+                        ('items',items),
+                        ('unit',unit),
+                        ('per_second',items/best if best else None),
+                        ('peak_bytes',peak),
+                        ('memory',memory)))
+
+def run_suite(sizes=DEFAULT_SIZES,names=None,repeat=3,seed=0,log=None):
+    '''measure every scenario in names (default all) at every size.  log is
+    called with each result as it is made.'''
+    names = list(SCENARIOS) if names is None else names
+    results = []
+    for n in sizes:
+        for name in names:
+            result = measure(name,n,repeat,seed)
+            if log is not None:
+                log(result)
+            results.append(result)
+    return OrderedDict((('python',platform.python_version()),
+                        ('numpy',np.__version__),
+                        ('platform',platform.platform()),
+                        ('results',results)))
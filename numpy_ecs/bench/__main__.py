@@ -0,0 +1,64 @@
+'''
+python -m numpy_ecs.bench [--sizes N ...] [--scenarios NAME ...] [--out FILE]
+
+Run the benchmark suite and write its JSON report to stdout or FILE.
+Progress is printed to stderr.
+
+This file is part of Numpy-ECS.
+Copyright (C) 2016 Elliot Hallmark (permafacture@gmail.com)
+
+Numpy-ECS is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 2 of the License, or
+(at your option) any later version.
+
+Data Oriented Python is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+from __future__ import absolute_import, division, print_function
+import sys
+import json
+import argparse
+
+from numpy_ecs.bench import SCENARIOS, DEFAULT_SIZES, run_suite
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m numpy_ecs.bench',
+        description='headless benchmarks of Numpy-ECS')
+    parser.add_argument('--sizes',nargs='+',type=float,default=DEFAULT_SIZES,
+        help='world sizes in entities, ie: 1e3 1e4 1e5 (default %(default)s)')
+    parser.add_argument('--scenarios',nargs='+',choices=list(SCENARIOS),
+        help='scenarios to run (default all)')
+    parser.add_argument('--repeat',type=int,default=3,
+        help='report the best of this many runs (default %(default)s)')
+    parser.add_argument('--seed',type=int,default=0)
+    parser.add_argument('--out',help='write the report here instead of stdout')
+    args = parser.parse_args(argv)
+
+    def log(result):
+        rate = result['per_second'] #None if the run was too fast to time
+        rate = 'n/a' if rate is None else '%.1f' % (rate,)
+        print('%(scenario)16s n=%(n)-9d %(seconds).4fs ' % result +
+              '%14s %s/s' % (rate,result['unit']), file=sys.stderr)
+
+    #keep chatter from building allocators out of the report
+    stdout, sys.stdout = sys.stdout, sys.stderr
+    try:
+        report = run_suite([int(n) for n in args.sizes],args.scenarios,
+                           args.repeat,args.seed,log)
+    finally:
+        sys.stdout = stdout
+    text = json.dumps(report,indent=2)
+    if args.out:
+        with open(args.out,'w') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+
+if __name__ == '__main__':
+    main()
@@ -20,6 +20,8 @@ along with this program.  If not, see <http://www.gnu.org/licenses/>.
 '''
 import numpy as np
 
+MAX_DIRTY_RANGES = 256 #dirty ranges kept before they collapse into one
+
 def _nearest_pow2(v):
     # From http://graphics.stanford.edu/~seander/bithacks.html#RoundUpPowerOf2
     # Credit: Sean Anderson
@@ -34,13 +36,27 @@ def _nearest_pow2(v):
 class DefraggingArrayComponent(object):
     '''holds a resize-able, re-allocateable, numpy array buffer'''
 
-    def __init__(self,name,dim,dtype,size=0):
-      ''' create a numpy array buffer of shape (size,dim) with dtype==dtype'''
+    def __init__(self,name,dim,dtype,size=0,track_dirty=False,
+                 double_buffered=False):
+      ''' create a numpy array buffer of shape (size,dim) with dtype==dtype
+
+      if track_dirty, every write through this Component (and any the 
+      allocator is told about) is recorded as a dirty range of rows, and
+      each row remembers the generation it was last written in.
+
+      if double_buffered, a second "front" buffer is kept for readers.
+      Writes go to the back buffer, and swap() exchanges the two.'''
       #TODO: might could alternatively instatiate with an existing numpy array?
       self.name = name
       self.datatype=dtype #calling this dtype would be confusing because this is not a numpy array!
       self._dim = dim
       self.capacity = size
+      self.track_dirty = track_dirty
+      self.double_buffered = double_buffered
+      self.generation = 0 #set by the allocator
+      self._dirty = [] #[(start,stop),...] see _add_dirty
+      #generation each row was last written in
+      self._stamps = np.zeros(size if track_dirty else 0,dtype=np.int64)
       if dim == (1,):
         self._buffer = np.empty(size,dtype=dtype) #shape = (size,) not (size,1)
         self.resize = self._resize_singledim
@@ -49,6 +65,21 @@ class DefraggingArrayComponent(object):
         self.resize = self._resize_multidim
       else:
         raise ValueError('''ArrayComponent dim must be >= 1''')
+      self._front = self._buffer.copy() if double_buffered else None
+      self._synced = True #back matched front after the last swap
+      self._swapped_at = 0 #generation of the last swap
+
+    def set_buffer(self,buffer):
+      '''use the array `buffer` as this Component's data, which is assumed
+      to be fully used'''
+      assert buffer.dtype == self.datatype, 'numpy dtype may not change'
+      self._buffer = buffer
+      self.capacity = len(buffer)
+      if self.double_buffered:
+          self._front = np.array(buffer)
+      self._stamps = np.zeros(len(buffer) if self.track_dirty else 0,
+                              dtype=np.int64)
+      self._dirty = []
 
     #def resize(self,count):
     #    '''resize this component to new size = count'''
@@ -63,10 +94,25 @@ class DefraggingArrayComponent(object):
         if self.capacity < new_capacity:
             #print "change capacity:",self.capacity,"->", new_capacity
             self.resize(_nearest_pow2(new_capacity))
+            if self.double_buffered:
+                front = np.empty_like(self._buffer)
+                front[:len(self._front)] = self._front
+                self._front = front
+            if self.track_dirty:
+                stamps = np.zeros(len(self._buffer),dtype=np.int64)
+                stamps[:len(self._stamps)] = self._stamps
+                self._stamps = stamps
             self.capacity = new_capacity
 
     def realloc(self,old_selector,new_selector):
+        '''move rows.  The moved rows are dirty, but keep the generation they
+        were written in.'''
         self._buffer[new_selector] = self._buffer[old_selector]
+        if self.double_buffered:
+            self._front[new_selector] = self._front[old_selector]
+        if self.track_dirty:
+            self._stamps[new_selector] = self._stamps[old_selector]
+            self._record_dirty(new_selector)
 
     #def push_from_index(self,index,size):
     #    '''push all data in buffer from start onward forward by size.
@@ -82,6 +128,126 @@ class DefraggingArrayComponent(object):
     #        self._buffer[index+size:size] = self._buffer[index:]
  
 
+    def _record_dirty(self,selector):
+      '''add the runs of rows selector touches to the dirty ranges.
+      returns those rows as a slice or a sorted array, for stamping.  Index
+      arrays and masks cost as much as the rows they select.'''
+      if isinstance(selector,tuple):
+          selector = selector[0] #only rows are tracked
+      if selector is Ellipsis:
+          selector = slice(None)
+      if isinstance(selector,slice):
+          start,stop,step = selector.indices(self.capacity)
+          rows = slice(start,max(start,stop))
+      elif np.ndim(selector) == 0:
+          start = int(selector) % self.capacity
+          rows = slice(start,start+1)
+      else:
+          rows = np.asarray(selector)
+          if rows.dtype == np.bool_:
+              rows = np.flatnonzero(rows)
+          else:
+              rows = np.unique(rows % self.capacity)
+          if not rows.size:
+              return slice(0,0)
+          breaks = np.flatnonzero(np.diff(rows) != 1) + 1
+          starts = rows[np.concatenate(([0],breaks))].tolist()
+          stops = (rows[np.concatenate((breaks - 1,[-1]))] + 1).tolist()
+          if len(starts) > MAX_DIRTY_RANGES:
+              starts, stops = starts[:1], stops[-1:]
+          for start, stop in zip(starts,stops):
+              self._add_dirty(start,stop)
+          return rows
+      if rows.start < rows.stop:
+          self._add_dirty(rows.start,rows.stop)
+      return rows
+
+    def mark_dirty(self,selector):
+      '''record that the rows in selector have changed.  selector is a slice,
+      an int, an index array or a mask.  Does nothing if this Component
+      does not track dirty rows.'''
+      if not self.track_dirty:
+          return
+      self._stamps[self._record_dirty(selector)] = self.generation
+
+    def _add_dirty(self,start,stop):
+      '''record a dirty range, merged into the last one if they touch.  If
+      more than MAX_DIRTY_RANGES pile up between clear_dirty calls they are
+      coalesced, and if that does not halve them, replaced by the one range
+      that covers them all.  The stamps of changed_since stay exact.'''
+      dirty = self._dirty
+      if dirty and start <= dirty[-1][1] and stop >= dirty[-1][0]:
+          dirty[-1] = (min(start,dirty[-1][0]),max(stop,dirty[-1][1]))
+          return
+      dirty.append((start,stop))
+      if len(dirty) > MAX_DIRTY_RANGES:
+          dirty = self.dirty_ranges()
+          if len(dirty) > MAX_DIRTY_RANGES // 2:
+              self._dirty = [(dirty[0][0],dirty[-1][1])]
+
+    def changed_since(self,generation,stop=None):
+      '''returns a sorted list of (start,stop) ranges of the rows before 
+      `stop` that were written in `generation` or later.  Only meaningful
+      if this Component tracks dirty rows.'''
+      changed = self._stamps[:self.capacity if stop is None else stop] >= generation
+      edges = np.flatnonzero(np.diff(np.concatenate(([0],changed.view(np.int8),[0]))))
+      return list(zip(edges[::2].tolist(),edges[1::2].tolist()))
+
+    def dirty_ranges(self):
+      '''returns a sorted list of non overlapping (start,stop) row ranges
+      that have changed since the last clear_dirty()'''
+      ranges = sorted(self._dirty)
+      coalesced = []
+      for start,stop in ranges:
+          if coalesced and start <= coalesced[-1][1]:
+              if stop > coalesced[-1][1]:
+                  coalesced[-1] = (coalesced[-1][0],stop)
+          else:
+              coalesced.append((start,stop))
+      self._dirty = coalesced
+      return list(coalesced)
+
+    def clear_dirty(self):
+      self._dirty = []
+
+    def front(self,selector):
+      '''read only view of the front buffer, which is the back buffer for
+      Components that are not double buffered'''
+      view = (self._front if self.double_buffered else self._buffer)[selector]
+      if isinstance(view,np.ndarray):
+          view.flags.writeable = False
+      return view
+
+    def swap(self,sync=True):
+      '''exchange the front and back buffers, and bring the new back buffer
+      up to date with the new front so writers like `pos += vel*dt` continue
+      from the latest values.  Components that track dirty rows copy only
+      the rows written in or after the generation of the previous synced
+      swap; the others copy every row.
+
+      Writers that rewrite every row each frame can pass sync=False to
+      copy nothing.  The back buffer then holds the values from before the
+      previous swap.'''
+      if not self.double_buffered:
+          return
+      self._buffer,self._front = self._front,self._buffer
+      if sync:
+          if self.track_dirty and self._synced:
+              ranges = self.changed_since(self._swapped_at)
+          else:
+              ranges = [(0,self.capacity)]
+          for start, stop in ranges:
+              self._buffer[start:stop] = self._front[start:stop]
+      self._synced = sync
+      self._swapped_at = self.generation
+
+    def write_all(self,selector,data):
+      '''write data to the back buffer and, if double buffered, the front.
+      Used for rows that are new, so readers never see garbage.'''
+      self[selector] = data
+      if self.double_buffered:
+          self._front[selector] = data
+
     def __getitem__(self,selector):
       #assert self.datatype == self._buffer.dtype #bug if numpy changes dtype
       return self._buffer[selector]
@@ -89,6 +255,8 @@ class DefraggingArrayComponent(object):
     def __setitem__(self,selector,data):
       self._buffer[selector]=data
       assert self.datatype == self._buffer.dtype, 'numpy dtype may not change'
+      if self.track_dirty:
+          self.mark_dirty(selector)
 
     def _resize_multidim(self,count):
       shape =(count,)+self._dim 
@@ -110,3 +278,138 @@ class DefraggingArrayComponent(object):
     def __repr__(self):
       return "<DefraggingArrayComponent: %s>"%self.name
 
+
+class SharedComponent(DefraggingArrayComponent):
+    '''a Component whose values are shared by many entities (flyweights),
+    like the vertices of a mesh that thousands of instances draw.
+
+    The allocator gives each entity a single row of this Component: the id
+    of a block of rows in `pool`, which holds every distinct value added
+    once.  Adding a value equal to one already interned reuses its block,
+    so n instances of a mesh store it once and _defrag moves one id for each
+    instead of the mesh.
+
+    In a query, the section of a shared component is the used rows of its
+    pool, and 'name__to__T' gives the pool row belonging to each row of T
+    (T's rows of an entity pair up with the rows of its block).  Accessors,
+    EntitySets and prefab overrides read and write ids.  Blocks are never
+    freed, and are found by the value they were interned with even if the
+    pool is written to since.'''
+
+    def __init__(self,name,dim,dtype,size=0,track_dirty=False,
+                 double_buffered=False):
+      DefraggingArrayComponent.__init__(self,name,(1,),np.int32,size,
+                                        track_dirty,double_buffered)
+      self.pool = DefraggingArrayComponent(name,dim,dtype,
+                                           track_dirty=track_dirty)
+      self.used = 0 #rows of pool in blocks
+      self._block_starts = []
+      self._block_sizes = []
+      self._arrays = None #(starts, sizes) as arrays, made when needed
+      self._interned = {} #{(shape, bytes): block id}
+
+    def intern(self,value):
+      '''the id of the block holding value, which is added to the pool if
+      it is not there already'''
+      pool = self.pool
+      value = np.array(value,dtype=pool.datatype)
+      shape = value.shape or (1,)
+      dim = pool._dim
+      assert shape == dim or (len(shape)>1 and shape[1:] == dim), \
+          "component '%s' expected shape %s, but got %s" % (
+          self.name,dim,value.shape)
+      value = value.reshape((-1,) + (() if dim == (1,) else dim))
+      key = (value.shape,value.tobytes())
+      block = self._interned.get(key)
+      if block is None:
+          block = len(self._block_starts)
+          start, stop = self.used, self.used + len(value)
+          pool.assert_capacity(stop)
+          pool.write_all(slice(start,stop),value)
+          self._block_starts.append(start)
+          self._block_sizes.append(len(value))
+          self._arrays = None
+          self._interned[key] = block
+          self.used = stop
+      return block
+
+    def block(self,block):
+      '''the rows of the pool in block (an id)'''
+      start = self._block_starts[block]
+      return self.pool[start:start+self._block_sizes[block]]
+
+    def _block_arrays(self):
+      if self._arrays is None:
+          self._arrays = (np.array(self._block_starts,dtype=np.intp),
+                          np.array(self._block_sizes,dtype=np.intp))
+      return self._arrays
+
+    def pool_rows(self,ids,owners):
+      '''ids is one block id per entity of a section, and owners the index
+      of the entity (into ids) of each row of another component T, as
+      mask_slices gives for 'name__to__T'.  returns the pool row of each
+      row of T.'''
+      starts, sizes = self._block_arrays()
+      ids = np.asarray(ids,dtype=np.intp)
+      counts = np.bincount(owners,minlength=len(ids))
+      assert np.all(counts <= sizes[ids]), \
+          "entities have more rows than their blocks of '%s'" % (self.name,)
+      firsts = np.cumsum(counts) - counts
+      rows = np.arange(len(owners)) - firsts[owners] + starts[ids][owners]
+      return rows.astype(np.int32)
+
+    def blocks(self):
+      '''[(key, array),...] of the pool, for persistence.write_blocks'''
+      starts, sizes = self._block_arrays()
+      prefix = 'shared/' + self.name
+      return [(prefix + '/rows',self.pool[:self.used]),
+              (prefix + '/starts',starts.astype(np.int64)),
+              (prefix + '/sizes',sizes.astype(np.int64))]
+
+    def restore(self,rows,starts,sizes):
+      '''inverse of blocks'''
+      self.pool.set_buffer(np.array(rows))
+      self.used = len(rows)
+      self._block_starts = starts.tolist()
+      self._block_sizes = sizes.tolist()
+      self._arrays = None
+      self._interned = {}
+      for block in range(len(self._block_starts)):
+          value = self.block(block)
+          self._interned[(value.shape,value.tobytes())] = block
+
+    def __repr__(self):
+      return "<SharedComponent: %s, %s blocks>"%(self.name,len(self._block_starts))
+
+class TagComponent(DefraggingArrayComponent):
+    '''a Component with no values, only presence, like 'selected' or
+    'enemy'.  Add an entity with {'enemy': True} to tag it.
+
+    Tags take part in class ids and queries like any Component, but hold no
+    buffer and _defrag moves nothing for them.  Reading a tag gives a read
+    only array of True (with zero strides, so it takes no memory) with one
+    row per tagged entity.  Writing to a tag does nothing.'''
+
+    def __init__(self,name):
+      DefraggingArrayComponent.__init__(self,name,(1,),np.bool_)
+
+    def set_buffer(self,buffer):
+      self.capacity = len(buffer)
+
+    def assert_capacity(self,new_capacity):
+      self.capacity = max(self.capacity,new_capacity)
+
+    def realloc(self,old_selector,new_selector):
+      pass
+
+    def front(self,selector):
+      return self[selector]
+
+    def __getitem__(self,selector):
+      return np.broadcast_to(np.True_,(self.capacity,))[selector]
+
+    def __setitem__(self,selector,data):
+      pass
+
+    def __repr__(self):
+      return "<TagComponent: %s>"%self.name
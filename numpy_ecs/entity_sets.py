@@ -0,0 +1,103 @@
+'''
+EntitySets provide vectorized access to the values of many entity instances
+(guids) at once.  Each attribute gathers the rows of every guid in the set
+into one array, and assigning to it scatters the values back, so that
+
+    units.position += movement
+
+moves every unit with one gather and one scatter.
+
+This file is part of Numpy-ECS.
+Copyright (C) 2016 Elliot Hallmark (permafacture@gmail.com)
+
+Numpy-ECS is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 2 of the License, or
+(at your option) any later version.
+
+Data Oriented Python is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+from __future__ import absolute_import, division, print_function
+import sys
+#python version compatability
+if sys.version_info < (3,0):
+    from future_builtins import zip, map
+
+import numpy as np
+
+def concatenated_ranges(starts,sizes):
+    '''returns the concatenation of arange(start,start+size) for every
+    start and size, without a python loop'''
+    sizes = np.asarray(sizes,dtype=np.intp)
+    total = sizes.sum()
+    offsets = np.cumsum(sizes) - sizes
+    return (np.arange(total,dtype=np.intp) - np.repeat(offsets,sizes)
+            + np.repeat(np.asarray(starts,dtype=np.intp),sizes))
+
+def build_row_indices(allocator,guids):
+    '''returns {component_name: index array} of the rows of all guids, in
+    the order of guids.  Components a guid does not have contribute no
+    rows for it.'''
+    table = allocator._allocation_table
+    rows = [table.index_of(guid) for guid in guids]
+    n_cols = len(table.column_names)
+    starts = np.array([tuple(table.starts[r]) for r in rows],
+                      dtype=np.intp).reshape(-1,n_cols)
+    sizes  = np.array([tuple(table.sizes[r]) for r in rows],
+                      dtype=np.intp).reshape(-1,n_cols)
+    return {name:concatenated_ranges(starts[:,j],sizes[:,j]) for j,name in
+            enumerate(table.column_names)}
+
+class EntitySet(object):
+    '''
+    A fixed collection of guids whose component values are read by
+    gathering and written by scattering.  Reading an attribute returns a
+    copy; write it back by assigning to the attribute.
+
+    Row indices are rebuilt only when the allocator's layout_generation
+    changes.'''
+
+    __slots__ = ('guids','_generation','_rows')
+
+    def __init__(self,guids):
+      # self._allocator is provided by the factory
+      self.guids = tuple(guids)
+      self._generation = None
+      self._rows = {} #{component_name: index array}
+
+    def _rebuild_rows(self):
+        allocator = self._allocator
+        self._rows = build_row_indices(allocator,self.guids)
+        self._generation = allocator.layout_generation
+
+    def rows(self,name):
+        '''the index array of this set's rows in Component `name`'''
+        if self._generation != self._allocator.layout_generation:
+            self._rebuild_rows()
+        return self._rows[name]
+
+    def __len__(self):
+        return len(self.guids)
+
+    def __repr__(self):
+      return "<EntitySet of %s guids>"%(len(self.guids),)
+
+def generate_entity_set(allocator):
+    '''return an EntitySet class with a gathering/scattering property for
+    every Component of allocator'''
+    NewEntitySet = type('DataEntitySet',(EntitySet,),{'__slots__':()})
+    for name in allocator.names:
+        component = allocator.component_dict[name]
+        def getter(entity_set, name=name, component=component):
+            return component[entity_set.rows(name)]
+        def setter(entity_set, data, name=name, component=component):
+            component[entity_set.rows(name)] = data
+        setattr(NewEntitySet,name,property(getter,setter))
+    NewEntitySet._allocator = allocator
+    return NewEntitySet
@@ -73,9 +73,58 @@ along with this program.  If not, see <http://www.gnu.org/licenses/>.
 #
 #
 from table import Table, INDEX_SEPERATOR
+from collections import namedtuple
+import threading
+import weakref
 import numpy as np
-from .table import Table, INDEX_SEPERATOR
+from .table import Table, INDEX_SEPERATOR, OFFSETS_SUFFIX, GUID_COLUMN
 from .accessors import AccessorFactory
+from .components import SharedComponent, TagComponent
+from .entity_sets import generate_entity_set, build_row_indices
+from .persistence import save_allocator, load_allocator, make_delta, replay_delta
+from .persistence import used_rows
+from .stats import AllocatorStats, clock, lap
+from .profiler import FrameProfiler
+from .guids import GuidPool
+from .prefabs import Prefab, SpawnBatch, rows_in_value, row_shape
+from .sparse import SparseComponent
+from .hibernation import Archive
+from .history import FrameHistory
+
+DELTA_HISTORY = 1024 #number of _defrags delta_since can reach back through
+
+# One step of a _defrag, for mirrors of Component arrays.  source and target
+# are slices of rows of the named component, which needs `capacity` rows
+# after the move.  Resizes without moves have source and target of None.
+# TagComponents have no data and no moves.
+LayoutMove = namedtuple('LayoutMove',('component','source','target','capacity'))
+
+def replay_layout_moves(journal,arrays):
+    '''apply a journal from subscribe_layout to a mirror, given as
+    {component name: array}.  Arrays too small for a move's capacity are
+    replaced by larger copies.  Returns arrays.'''
+    for move in journal:
+        array = arrays[move.component]
+        if len(array) < move.capacity:
+            grown = np.empty((move.capacity,)+array.shape[1:],dtype=array.dtype)
+            grown[:len(array)] = array
+            arrays[move.component] = array = grown
+        if move.source is not None:
+            array[move.target] = array[move.source]
+    return arrays
+
+def _coalesce(sources,targets):
+    '''merge moves of adjacent rows to adjacent rows into block moves'''
+    merged_sources, merged_targets = [], []
+    for source, target in zip(sources,targets):
+        if merged_sources and merged_sources[-1].stop == source.start and \
+                merged_targets[-1].stop == target.start:
+            merged_sources[-1] = slice(merged_sources[-1].start,source.stop,1)
+            merged_targets[-1] = slice(merged_targets[-1].start,target.stop,1)
+        else:
+            merged_sources.append(source)
+            merged_targets.append(target)
+    return merged_sources, merged_targets
 
 def verify_component_schema(allocation_schema):
     '''given an allocation schema as a list of lists, return True if the schema
@@ -102,32 +151,204 @@ class GlobalAllocator(object):
 
     see comments at top of file for details'''
 
-    def __init__(self,components,allocation_scheme):
+    def __init__(self,components,allocation_scheme,sparse_components=()):
+        '''sparse_components are SparseComponents, kept outside the Table
+        and the allocation scheme.  See numpy_ecs.sparse'''
         self.component_dict = {component.name:component for component in components}
+        self.sparse_dict = {component.name:component for component in sparse_components}
+        assert not set(self.sparse_dict) & set(self.component_dict), \
+            "sparse components need names of their own"
         self._memoized = {} #for selectors_from_component_names 
+        #{key of _memoized: (first, stop, {'guid__to__T': column of T})} of
+        # queries with guid indices, see _guids_deleted
+        self._guid_queries = {}
 
         names = tuple(comp.name for comp in components) 
         self.names = names 
         self._allocation_table = Table(names, tuple(allocation_scheme))
  
         self._cached_adds = list()
-        self._next_guid = 0
+        self._cached_spawns = list() #SpawnBatches, see spawn
+        self._cached_moves = dict() #{guid: dormant}, see deactivate
+        self.archive = Archive((name,np.dtype(c.datatype),row_shape(c)) for
+                               name, c in zip(names,components)) #see hibernate
+        self._prefabs = {} #{name: Prefab}
+        self.guid_pool = GuidPool() #hands out generational guids
         self.__accessor_factory = AccessorFactory(self).generate_accessor()
-        self.__accessors = [] #accessors that have been handed out
+        #accessors that have been handed out and are still referenced
+        self.__accessors = weakref.WeakValueDictionary()
+        self.__entity_set_class = generate_entity_set(self)
+
+        #for delta_since.  generation is the clock dirty rows are stamped
+        # with; it ticks at each _defrag, swap and delta taken.  The log has
+        # an entry for each _defrag
+        self.generation = 0
+        #ticks whenever cached views and row indices may be stale, see
+        # _layout_changed.  Deltas do not tick it.
+        self.layout_generation = 0
+        self._pending_removes = {} #{table row: guid} deleted but not defragged
+        self._delta_log = [] #[(generation, removed guids, ((guid,sizes,dormant),...)),...]
+        self._delta_floor = 0 #log is incomplete for generations <= this
+        self._layout_subscribers = [] #see subscribe_layout
+        self.stats = None #see enable_stats
+        self.profiler = None #see enable_profiler
+        self.history = None #see enable_history
+        self._probes = () #the enabled instruments of the two above
+        #hold while reading front buffers so swap cannot happen meanwhile
+        self.front_lock = threading.Lock()
 
     def accessor_from_guid(self,guid):
-        accessor = self.__accessor_factory(guid)
-        self.__accessors.append(accessor)
+        accessor = self.__accessors.get(guid)
+        if accessor is None:
+            accessor = self.__accessor_factory(guid)
+            self.__accessors[guid] = accessor
         return accessor
 
+    def entity_set(self,guids):
+        '''return an EntitySet for gathering and scattering the values of
+        many guids at once, ie: `units.position += movement`'''
+        return self.__entity_set_class(guids)
+
     @property
     def next_guid(self):
-        self._next_guid += 1
-        return self._next_guid
+        return self.guid_pool.acquire()
+
+    def is_alive(self,guid):
+        '''False once guid is deleted, even if its index has been reused'''
+        return self.guid_pool.is_alive(guid)
 
     @property
     def guids(self):
         return tuple(self._allocation_table.guids)
+
+    def entity_counts(self):
+        '''{'live': n, 'tombstoned': n, 'staged': n} where tombstoned guids
+        are deleted but still hold rows until the next _defrag, and staged
+        guids are added but not yet given rows'''
+        guids = self._allocation_table.guids
+        tombstoned = guids.count(None)
+        return {'live'      : len(guids) - tombstoned,
+                'tombstoned': tombstoned,
+                'staged'    : len(self._cached_adds) +
+                              sum(map(len,self._cached_spawns))}
+
+    def memory_report(self,sample=None):
+        '''returns a dict of where memory goes:
+
+          'components': {name: {'capacity_rows', 'capacity_bytes',
+                                'used_rows', 'slack_rows', 'slack_bytes',
+                                'tombstoned_rows', 'tombstoned_bytes',
+                                'extra_bytes', 'sections'}}
+          'table':      {'rows', 'python_bytes', 'sampled'}
+          'sparse':     {name: {'rows', 'capacity_bytes'}}
+          'hibernated': {'entities', 'compressed_bytes'}
+          'history':    {'frames', 'bytes'}, see enable_history
+          'entities':   see entity_counts
+
+        capacity is the allocated rows and used is the rows of the Table,
+        tombstoned included.  Tombstoned rows are freed by the next _defrag.
+        extra_bytes are front buffers, dirty stamps and shared pools.  sections is
+        {class_id: rows} of every class present, with class ids as strings
+        like '1,0,1' so the report can be written as JSON.
+
+        Measuring the python side of the Table walks every row.  Pass sample
+        to measure only that many rows and extrapolate, which keeps the
+        report cheap enough to take every second.'''
+        table = self._allocation_table
+        sections = table.section_sizes()
+        tombstoned = [0] * len(self.names)
+        for row in self._pending_removes:
+            for i, size in enumerate(table.sizes[row]):
+                tombstoned[i] += size
+        components = {}
+        for i, (name, used) in enumerate(zip(self.names,used_rows(table))):
+            component = self.component_dict[name]
+            buf = component[:]
+            row_bytes = 0 if isinstance(component,TagComponent) else buf[:1].nbytes
+            extra = 0
+            if component.double_buffered:
+                extra += component._front.nbytes
+            if component.track_dirty:
+                extra += component._stamps.nbytes
+            if isinstance(component,SharedComponent):
+                extra += component.pool[:].nbytes
+            components[name] = {
+                'capacity_rows'   : len(buf),
+                'capacity_bytes'  : len(buf) * row_bytes,
+                'used_rows'       : used,
+                'slack_rows'      : len(buf) - used,
+                'slack_bytes'     : (len(buf) - used) * row_bytes,
+                'tombstoned_rows' : tombstoned[i],
+                'tombstoned_bytes': tombstoned[i] * row_bytes,
+                'extra_bytes'     : extra,
+                'sections'        : {','.join(map(str,c)):rows[i]
+                                     for c,rows in sections.items()
+                                     if rows[i]}}
+        return {'components': components,
+                'table'     : {'rows'        : len(table.guids),
+                               'python_bytes': table.python_nbytes(sample),
+                               'sampled'     : sample is not None},
+                'sparse'    : {name:{'rows'          : len(c),
+                                     'capacity_bytes': c.values[:].nbytes +
+                                         c.guids.nbytes + c.sparse.nbytes}
+                               for name, c in self.sparse_dict.items()},
+                'hibernated': {'entities'        : len(self.archive),
+                               'compressed_bytes': self.archive.nbytes},
+                'history'   : {'frames': len(self.history) if self.history else 0,
+                               'bytes' : self.history.nbytes if self.history else 0},
+                'entities'  : self.entity_counts()}
+
+    def enable_stats(self,history=256):
+        '''start recording timings and counters of _defrag and queries.
+        returns the AllocatorStats, which is also self.stats'''
+        self.stats = AllocatorStats(history)
+        self._update_probes()
+        return self.stats
+
+    def disable_stats(self):
+        self.stats = None
+        self._update_probes()
+
+    def enable_profiler(self,capacity=65536):
+        '''start recording spans of _defrag phases, queries and Systems in
+        a ring buffer of capacity spans.  returns the FrameProfiler, which
+        is also self.profiler'''
+        self.profiler = FrameProfiler(capacity)
+        self._update_probes()
+        return self.profiler
+
+    def disable_profiler(self):
+        self.profiler = None
+        self._update_probes()
+
+    def enable_history(self,names=None,frames=60,rows=None):
+        '''start keeping the last `frames` frames of the Components in names
+        (default all that have data) for rollback, each in a ring allocated
+        now of `rows` rows per frame (default their capacity).  returns the
+        FrameHistory, which is also self.history.  See numpy_ecs.history'''
+        if names is None:
+            names = [name for name in self.names
+                     if not isinstance(self.component_dict[name],TagComponent)]
+        self.history = FrameHistory(self,names,frames,rows)
+        return self.history
+
+    def disable_history(self):
+        self.history = None
+
+    def record_frame(self):
+        '''copy the recorded Components into the history.  Pending adds and
+        deletes are applied first.'''
+        self.history.record(self)
+
+    def rollback(self,k=1):
+        '''restore the values, and layout if _defrag moved data since, of
+        the frame recorded k record_frames before the newest.  Frames after
+        it are forgotten.  Views from earlier queries are stale after this.'''
+        self.history.rollback(self,k)
+
+    def _update_probes(self):
+        self._probes = tuple(probe for probe in (self.stats,self.profiler)
+                             if probe is not None)
     #def _class_id_from_guid(guid):
     #    #assumes entity has non-zero size for every component that 
     #    #  defines it's class.  This is the definition of a class_id and is
@@ -154,116 +375,557 @@ class GlobalAllocator(object):
     #        else 1 for name in names)
     #    return self.entity_class_from_tuple(entity_tuple)
 
-    def add(self,values_dict,guid=None):
-        component_dict = self.component_dict
+    def _convert(self,name,value):
+        '''converts value to a numpy array with appropriate shape for 
+        component name.  Values of SharedComponents become block ids.'''
+        if name in self.sparse_dict:
+            component = self.sparse_dict[name]
+        else:
+            component = self.component_dict[name]
+        if isinstance(component,SharedComponent):
+            blocks = component.used
+            value = component.intern(value)
+            if component.used != blocks:
+                self._layout_changed() #queried pool sections are too short
+        value = np.array(value,dtype = component.datatype)
+
+        shape = value.shape or (1,)
+        dim = component._dim
+        assert shape == dim or (len(shape)>1 and shape[1:] == dim), \
+            "component '%s' expected shape %s, but got %s" % (
+            component.name,component._dim,value.shape)
+            #len(shape) is a look before I leap. No exceptions please
+        return value
 
-        def convert_to_component_array(component,value):
-            '''converts value to a numpy array with appropriate shape for 
-            component'''
-            value = np.array(value,dtype = component.datatype)
-
-            shape = value.shape or (1,)
-            dim = component._dim
-            assert shape == dim or (len(shape)>1 and shape[1:] == dim), \
-                "component '%s' expected shape %s, but got %s" % (
-                component.name,component._dim,value.shape)
-                #len(shape) is a look before I leap. No exceptions please
-            return value
-
-        result = {'guid': guid or self.next_guid}
-        for name, value in values_dict.items():
-            result[name] = convert_to_component_array(component_dict[name],value)
-        assert result['guid'] not in {d['guid'] for d in self._cached_adds}, \
-            "cannot add a guid twice"
+    def add(self,values_dict,guid=None):
+        result = {name:self._convert(name,value)
+                  for name, value in values_dict.items()}
+        if guid is None:
+            guid = self.next_guid
+        else:
+            self.guid_pool.claim(guid) #asserts guid is not already added
+        for name in [n for n in result if n in self.sparse_dict]:
+            self.sparse_dict[name].insert(guid,result.pop(name))
+        result['guid'] = guid
         self._cached_adds.append(result)
         return result['guid']
 
+    def register_prefab(self,name,values_dict):
+        '''convert values_dict (as for add) once, for spawning many copies
+        of it with spawn.  returns the Prefab'''
+        assert not set(values_dict) & set(self.sparse_dict), \
+            "prefabs cannot hold sparse components"
+        arrays = {key:self._convert(key,value)
+                  for key, value in values_dict.items()}
+        prefab = Prefab(name,arrays,self.component_dict,self.names)
+        assert self._allocation_table.entity_class_from_tuple(prefab.sizes) \
+            in self._allocation_table.known_class_ids, \
+            "prefab must corispond to a class id in the allocation schema"
+        self._prefabs[name] = prefab
+        return prefab
+
+    def spawn(self,prefab,n,overrides=None):
+        '''stage n copies of a registered prefab (its name or the Prefab).
+        overrides is {component name: values}, with either one value per
+        instance (repeated over the instance's rows) or one per row of all
+        instances.  returns an int64 array of the new guids.'''
+        if not isinstance(prefab,Prefab):
+            prefab = self._prefabs[prefab]
+        converted = {}
+        for name, value in (overrides or {}).items():
+            assert name in prefab.arrays, \
+                "%s is not a component of prefab %s"%(name,prefab.name)
+            value = np.asarray(value,dtype=self.component_dict[name].datatype)
+            assert value.shape[1:] == row_shape(self.component_dict[name]), \
+                "override of %s has rows of shape %s"%(name,value.shape[1:])
+            converted[name] = value
+        acquire = self.guid_pool.acquire
+        guids = [acquire() for _ in range(n)]
+        if n:
+            self._cached_spawns.append(SpawnBatch(prefab,guids,converted))
+        return np.array(guids,dtype=np.int64)
+
+    def deactivate(self,guids):
+        '''move guids into the dormant section of their class at the next
+        _defrag.  Queries (and so Systems and delete_where) skip dormant
+        entities, but they keep their guids and values, and Accessors and
+        EntitySets still reach them.  Their rows move in blocks, in the
+        journal sent to layout subscribers.  Guids added, spawned or woken
+        since the last _defrag are added straight into the dormant section.'''
+        for guid in guids:
+            assert guid not in self.archive, "wake %s before deactivating it"%(guid,)
+            self._cached_moves[guid] = True
+
+    def activate(self,guids):
+        '''move dormant guids back into their class at the next _defrag'''
+        for guid in guids:
+            assert guid not in self.archive, "wake %s before activating it"%(guid,)
+            self._cached_moves[guid] = False
+
+    def is_dormant(self,guid):
+        '''whether guid is dormant, or will be after the next _defrag.
+        Pending adds and hibernating guids are not.'''
+        if guid in self._cached_moves:
+            return self._cached_moves[guid]
+        table = self._allocation_table
+        try:
+            return table.is_dormant(table.index_of(guid))
+        except ValueError:
+            assert self.is_alive(guid), "guid %s is not alive"%(guid,)
+            return False
+
+    def _stage_moves(self):
+        '''stage the guids of deactivate and activate in their new section,
+        in row order.  returns ([(guid, sizes, dormant, old slices),...],
+        {guid: dormant}), the first for _apply_compress to carry their rows
+        over and the second of guids with no rows yet, for _defrag to stage
+        in their section when it adds them.'''
+        table = self._allocation_table
+        rows = []
+        unplaced = {}
+        for guid, dormant in self._cached_moves.items():
+            try:
+                row = table.index_of(guid)
+            except ValueError:
+                unplaced[guid] = dormant #pending add, or deleted
+                continue
+            if table.is_dormant(row) != dormant:
+                rows.append((row,guid,dormant))
+        moves = []
+        for row, guid, dormant in sorted(rows):
+            sizes = tuple(table.sizes[row])
+            old = tuple(table.slices_from_guid(guid))
+            self._pending_removes[row] = guid
+            table.stage_delete(guid)
+            table.stage_add(guid,sizes,dormant)
+            moves.append((guid,sizes,dormant,old))
+        self._cached_moves = dict()
+        return moves, unplaced
+
+    def _move_plan(self,moved,plan):
+        '''the block moves that carry guids staged by _stage_moves from
+        their old rows to their new ones, through scratch rows past the peak
+        of the compress plan, which its own moves never reach.  moved is
+        [(guid, old slices),...] in row order.  returns [(park sources,
+        park targets, unpark sources, unpark targets),...] per column.'''
+        table = self._allocation_table
+        new_slices = [tuple(table.slices_from_guid(guid)) for guid, old in moved]
+        result = []
+        for j, (peak, sources, targets) in enumerate(plan):
+            park_sources, park_targets, unpark_targets = [], [], []
+            scratch = peak
+            for (guid, old), new in zip(moved,new_slices):
+                size = old[j].stop - old[j].start
+                if size:
+                    park_sources.append(old[j])
+                    park_targets.append(slice(scratch,scratch+size,1))
+                    unpark_targets.append(new[j])
+                    scratch += size
+            unpark_sources = park_targets
+            result.append(_coalesce(park_sources,park_targets) +
+                          _coalesce(unpark_sources,unpark_targets))
+        return result
+
+    def hibernate(self,guids):
+        '''compress the values of guids into self.archive and remove their
+        rows from the Components at the next _defrag.  The guids stay alive
+        for wake.  See numpy_ecs.hibernation'''
+        guids = list(guids)
+        if not guids:
+            return
+        table = self._allocation_table
+        rows = build_row_indices(self,guids)
+        sizes = [tuple(table.sizes[table.index_of(guid)]) for guid in guids]
+        self.archive.store(guids,sizes,{name:self.component_dict[name][rows[name]]
+                                        for name in self.names})
+        rows, deleted = table.stage_delete_rows([table.index_of(g) for g in guids])
+        self._pending_removes.update(zip(rows.tolist(),deleted.tolist()))
+        self._guids_deleted(rows)
+        for guid in guids:
+            self._cached_moves.pop(guid,None)
+
+    def wake(self,guids):
+        '''stage hibernated guids to be added back, with their values, at
+        the next _defrag'''
+        for guid, values in self.archive.take(guids):
+            values['guid'] = guid
+            self._cached_adds.append(values)
+
+    def is_hibernating(self,guid):
+        return guid in self.archive
+
     def delete(self,guid):
+        if guid in self.archive:
+            self.archive.discard(guid)
+            self.guid_pool.release(guid)
+            for sparse in self.sparse_dict.values():
+                sparse.remove(guid)
+            return
         alloc_table = self._allocation_table
+        row = alloc_table.index_of(guid)
+        self._pending_removes[row] = guid
         alloc_table.stage_delete(guid)
+        self.guid_pool.release(guid)
+        self._guids_deleted((row,))
+        for sparse in self.sparse_dict.values():
+            sparse.remove(guid)
+
+    def delete_where(self,query,mask_fn,sep=INDEX_SEPERATOR):
+        '''delete every guid in query's section for which mask is True, where
+        mask = mask_fn(*(sections[name] for name in query)) has one value per
+        guid in the section.  ie: with a size 1 component,
+
+            allocator.delete_where(('ttl',), lambda ttl: ttl <= 0)
+
+        returns an array of the deleted guids.'''
+        alloc_table = self._allocation_table
+        sections = self.selectors_from_component_query(query,sep)
+        mask = np.asarray(mask_fn(*(sections[name] for name in query)),dtype=bool)
+        first,stop = alloc_table.section_rows(tuple(n for n in query if sep not in n))
+        assert mask.shape == (stop-first,), \
+            "mask must have one value for each of the %s guids in the section"%(stop-first,)
+        rows, deleted = alloc_table.stage_delete_rows(np.flatnonzero(mask) + first)
+        self._pending_removes.update(zip(rows.tolist(),deleted.tolist()))
+        self._guids_deleted(rows)
+        self.guid_pool.release_many(deleted)
+        for sparse in self.sparse_dict.values():
+            sparse.remove_many(deleted)
+        return deleted
+
+    def _bump_generation(self):
+        self.generation += 1
+        for component in self.component_dict.values():
+            component.generation = self.generation
+
+    def _layout_changed(self):
+        '''forget everything that depends on where guids are in Components.
+        Accessors and EntitySets notice layout_generation has changed on
+        their own.'''
+        self.layout_generation += 1
+        self._memoized = dict()
+        self._guid_queries = {}
+
+    def _guids_deleted(self,rows):
+        '''write -1 over the rows of the Table rows just deleted in the
+        'guid__to__T' indices of memoized queries, in place.  Costs as much
+        as the rows deleted, not the section.'''
+        if not self._guid_queries:
+            return
+        table = self._allocation_table
+        rows = np.asarray(rows,dtype=np.intp).reshape(-1)
+        for key, (first, stop, columns) in self._guid_queries.items():
+            hit = rows[(rows >= first) & (rows < stop)].tolist()
+            if not hit:
+                continue
+            result = self._memoized[key][0]
+            base = table.starts[first]
+            for name, j in columns.items():
+                index = result[name]
+                for row in hit:
+                    start = table.starts[row][j] - base[j]
+                    index[start:start + table.sizes[row][j]] = -1
+
+    def _apply_compress(self,moved=()):
+        '''compress the allocation table and move Component data to match,
+        along with the rows of guids moved between sections (see
+        _move_plan).  Layout subscribers are sent the journal of moves.'''
+        alloc_table = self._allocation_table
+        component_dict = self.component_dict
+        journal = [] if self._layout_subscribers else None
+        probes = self._probes
+        if probes:
+            start = clock()
+        plan = alloc_table.compress()
+        self.guid_pool.recycle() #the Table no longer holds deleted guids
+        if moved:
+            move_plan = self._move_plan(moved,plan)
+        else:
+            move_plan = [((),(),(),())]*len(plan)
+        if probes:
+            start = lap(probes,'compress',start)
+        for name, (new_size, sources, targets), (park_sources, park_targets,
+                unpark_sources, unpark_targets) in zip(alloc_table.column_names,
+                                                       plan,move_plan):
+            component = component_dict[name]
+            if isinstance(component,TagComponent):
+                component.assert_capacity(new_size) #no data to move
+                continue
+            if park_targets:
+                new_size = park_targets[-1].stop #room for the scratch rows
+                sources = tuple(park_sources) + sources + tuple(unpark_sources)
+                targets = tuple(park_targets) + targets + tuple(unpark_targets)
+            if journal is not None:
+                if sources:
+                    journal.extend(LayoutMove(name,source,target,new_size)
+                                   for source,target in zip(sources,targets))
+                elif new_size != component.capacity:
+                    journal.append(LayoutMove(name,None,None,new_size))
+            if probes:
+                for probe in probes:
+                    probe.moved(component,sources,component.capacity < new_size)
+            component.assert_capacity(new_size)
+            for source,target in zip(sources,targets):
+                component.realloc(source,target)
+        if probes:
+            lap(probes,'move',start)
+        if journal is not None:
+            for callback in self._layout_subscribers:
+                callback(self.generation,journal)
+
+    def subscribe_layout(self,callback):
+        '''call callback(generation, journal) whenever _defrag moves data,
+        where journal is a list of LayoutMove in the order they were made.
+        See replay_layout_moves.'''
+        self._layout_subscribers.append(callback)
+
+    def unsubscribe_layout(self,callback):
+        self._layout_subscribers.remove(callback)
 
     def _defrag(self):
        alloc_table = self._allocation_table
        component_dict  = self.component_dict
        adds_dict  = self._cached_adds
-       if (not adds_dict) and (None not in alloc_table.guids):
+       spawns = self._cached_spawns
+       if (not adds_dict) and (not spawns) and (not self._cached_moves) and \
+               (None not in alloc_table.guids):
            return  #nothing to do
 
        #delete_set = self._cached_deletes
-       def safe_len(item):
-           if item is None:
-               return 0
-           shape = item.shape
-           if len(shape) > 1:
-               #TODO only supports arrays like [n] and [1,n] !!!
-               #TODO Can't think of fix or what one would be expecting but I 
-               #TODO must note this limitation
-               return shape[0]
-           else:
-               return 1
+       safe_len = rows_in_value
 
+       self._bump_generation()
+       probes = self._probes
+       if probes:
+           for probe in probes:
+               probe.begin(self.generation)
+           start = clock()
+       moves, unplaced = self._stage_moves()
+       staged = [(guid,sizes,dormant) for guid,sizes,dormant,old in moves]
        for add in self._cached_adds:
            guid = add['guid']
            add = tuple(safe_len(add.get(name,None)) \
                      for name in alloc_table.column_names)
-           alloc_table.stage_add(guid,add)
-
-       #defrag
-       #print "defrag"
-       for name, (new_size, sources, targets) in zip(alloc_table.column_names,alloc_table.compress()):
-           #if name == 'component_1': print "working on component_1"
-           component = component_dict[name]
-           component.assert_capacity(new_size)
-           for source,target in zip(sources,targets):
-               #if name == "component_1":
-               #  print "moving",component[source],"to",target
-               component[target] = component[source]
+           dormant = unplaced.get(guid,False)
+           alloc_table.stage_add(guid,add,dormant)
+           staged.append((guid,add,dormant))
+       for batch in spawns:
+           sizes = batch.prefab.sizes
+           for guid in batch.guids:
+               dormant = unplaced.get(guid,False)
+               alloc_table.stage_add(guid,sizes,dormant)
+               staged.append((guid,sizes,dormant))
+       self._delta_log.append((self.generation,
+           tuple(self._pending_removes.values()), tuple(staged)))
+       if len(self._delta_log) > DELTA_HISTORY:
+           self._delta_floor = self._delta_log.pop(0)[0]
+       self._pending_removes = {}
+       if probes:
+           lap(probes,'stage',start)
+
+       with self.front_lock: #readers of front buffers see moves all at once
+         #defrag
+         #print "defrag"
+         self._apply_compress([(guid,old) for guid,sizes,dormant,old in moves])
  
-       #apply adds
-       for add in self._cached_adds:
-           guid = add['guid']
-           for name, this_slice in zip(alloc_table.column_names,alloc_table.slices_from_guid(guid)):
-               if name in add:
-                 component_dict[name][this_slice] = add[name]
+         #apply adds
+         if probes:
+             start = clock()
+         for add in self._cached_adds:
+             guid = add['guid']
+             for name, this_slice in zip(alloc_table.column_names,alloc_table.slices_from_guid(guid)):
+                 if name in add:
+                   component_dict[name].write_all(this_slice,add[name])
+         #a batch was staged in one run, so the rows of its active instances
+         # are contiguous, and so are those of its dormant ones
+         for batch in spawns:
+             if unplaced:
+                 asleep = np.array([unplaced.get(guid,False) for guid in batch.guids])
+                 runs = [run for run in (~asleep,asleep) if run.any()]
+             else:
+                 runs = [None]
+             for run in runs:
+                 if run is None:
+                     first, count = batch.guids[0], len(batch)
+                 else:
+                     first, count = batch.guids[int(np.argmax(run))], int(run.sum())
+                 slices = alloc_table.slices_from_guid(first)
+                 for name, this_slice, size in zip(alloc_table.column_names,slices,
+                                                   batch.prefab.sizes):
+                     if size:
+                       rows = slice(this_slice.start,this_slice.start+size*count)
+                       data = batch.data(name)
+                       if count != len(batch):
+                           data = data[np.repeat(run,size)]
+                       component_dict[name].write_all(rows,data)
+         if probes:
+             lap(probes,'add',start)
 
        #reset
        self._cached_adds = list()
-       self._memoized = dict()
-       for accessor in self.__accessors:
-           accessor._dirty = True
+       self._cached_spawns = list()
+       self._layout_changed()
+       if probes:
+           for probe in probes:
+               probe.end()
+
+    def delta_since(self,generation):
+        '''returns bytes describing every change since `generation`, which
+        apply_delta can replay on a replica.  Pass 0 for a full copy, or
+        the value of self.generation read right after the previous delta.
+
+        Includes guids removed and added, and rows written since generation
+        for Components that track dirty rows (all used rows for the others).
+        Moves made by _defrag are not sent: the replica's own Table makes 
+        the same moves.  Pending adds and deletes are not included.'''
+        return make_delta(self,generation)
+
+    def apply_delta(self,delta):
+        '''replay bytes from another allocator's delta_since'''
+        replay_delta(self,delta)
+
+    def swap(self,sync=True):
+        '''exchange front and back buffers of all double buffered Components,
+        while holding front_lock, and sync the back buffers unless sync is
+        False; see DefraggingArrayComponent.swap.  Views from earlier queries
+        are stale after this.'''
+        with self.front_lock:
+            self._bump_generation() #rows written from now on are newer
+            for component in self.component_dict.values():
+                component.swap(sync)
+            self._layout_changed()
+
+    def save(self,path):
+        '''write every Component and the allocation Table to path.  Pending
+        adds and deletes are applied first.'''
+        save_allocator(self,path)
+
+    @classmethod
+    def load(cls,path,mode='c'):
+        '''return a new allocator from a file written by save.  Component
+        arrays are memory mapped from the file and paged in lazily; the
+        Table is read whole and takes most of the time to load.  The
+        default mode 'c' keeps changes in memory (copy on write); 'r+' writes
+        them through to the file.'''
+        return load_allocator(cls,path,mode)
 
     def is_valid_query(self,query,sep=INDEX_SEPERATOR):
         known_names = self.names
         for x in query:
-            if (sep not in x) and (x not in known_names):
+            if x.endswith(OFFSETS_SUFFIX) and x[:-len(OFFSETS_SUFFIX)] in known_names:
+                continue
+            if (sep not in x) and (x not in known_names) and \
+                    (x not in self.sparse_dict):
                 print "%s in query is not valid"%x
                 return False
         return True
 
-    def selectors_from_component_query(self,query,sep=INDEX_SEPERATOR):
+    def selectors_from_component_query(self,query,sep=INDEX_SEPERATOR,
+                                       writes=(),front=False):
         #TODO add indicies to doc string
         '''takes: ['comp name 1', 'comp name 3', ...] #list tuple or set
            returns {'component name 1': component1[selector] ...}
            where selector is for the section where all components
-           are defined'''
+           are defined
+
+           'guid__to__name' in query gives an array of the guid owning each
+           row of component name in its section (-1 for deleted guids).
+
+           'name__offsets' in query gives the offset of each guid's first row
+           in name's section, for per guid reductions like
+           np.add.reduceat(sections['name'], sections['name__offsets'])
+
+           writes names the components in query that the caller will write
+           to.  Their sections are marked dirty in Components that track
+           dirty rows.
+
+           if front, views are read only and come from the front buffer of
+           double buffered Components.  Hold front_lock while using them
+           if another thread may call swap.'''
         assert isinstance(query,tuple), 'argument must be hashable'
+        if self.sparse_dict:
+          sparse_names = tuple(n for n in query if
+                               n.split(sep)[0] in self.sparse_dict)
+          if sparse_names:
+            return self._join_sparse(query,sparse_names,sep,writes,front)
         known_names = self.names
         assert self.is_valid_query(query), \
             'col_names must be valid component names and index names'
+        assert not (front and writes), 'front buffers are read only'
         cache = self._memoized
-        if query not in cache:
+        key = (query,front)
+        probes = self._probes
+        if probes:
+          hit = key in cache
+          start = clock()
+        if key not in cache:
           indices = tuple(filter(lambda x: sep in x, query))
-          col_names = tuple(filter(lambda x: x not in indices, query))
+          offsets = tuple(filter(lambda x: x.endswith(OFFSETS_SUFFIX), query))
+          col_names = tuple(filter(lambda x: x not in indices+offsets, query))
           table = self._allocation_table
-          selectors, indices = table.mask_slices(col_names,indices)
+          selectors, indices = table.mask_slices(col_names,indices,offsets)
           cdict = self.component_dict
-          result = {n:cdict[n][s] for n,s in selectors.items()}
-          result.update({n:np.array(lst) for n,lst in indices.items()})
-          cache[query] = result
+          for name in indices:
+            shared = cdict.get(name.split(sep)[0])
+            if isinstance(shared,SharedComponent):
+              assert shared.name in selectors, \
+                  '%s must be queried with %s' % (shared.name,name)
+              ids = shared[selectors[shared.name]]
+              indices[name] = shared.pool_rows(ids,indices[name])
+          for name in selectors:
+            if isinstance(cdict[name],SharedComponent):
+              selectors[name] = slice(0,cdict[name].used)
+          if front:
+            result = {n:self._storage(n).front(s) for n,s in selectors.items()}
+          else:
+            result = {n:self._storage(n)[s] for n,s in selectors.items()}
+          result.update(indices)
+          cache[key] = result, selectors
+          columns = {name:known_names.index(name.split(sep)[1])
+                     for name in indices if name.split(sep)[0] == GUID_COLUMN}
+          if columns:
+            first, stop = table.section_rows(col_names)
+            self._guid_queries[key] = first, stop, columns
         else:
-          result = cache[query]
+          result, selectors = cache[key]
+        for name in writes:
+          assert name in selectors, '%s written but not queried' % (name,)
+          self._storage(name).mark_dirty(selectors[name])
+        if probes:
+          stop = clock()
+          for probe in probes:
+            probe.query(query,hit,start,stop)
         return dict(result) #return copy of cached result
 
+    def _join_sparse(self,query,sparse_names,sep,writes,front):
+        '''selectors_from_component_query for a query naming SparseComponents.
+        Sparse sets change without a _defrag, so they are joined every call.
+        'S__to__T' is S.join of a 'guid__to__T' index.'''
+        sparse = self.sparse_dict
+        dense = tuple(n for n in query if n not in sparse_names)
+        guid_names = {n:GUID_COLUMN + sep + n.split(sep)[1]
+                      for n in sparse_names if sep in n}
+        extra = tuple(sorted(set(guid_names.values()) - set(dense)))
+        result = self.selectors_from_component_query(dense + extra,sep,
+            tuple(n for n in writes if n not in sparse),front)
+        for name in sparse_names:
+            if name in guid_names:
+                joined = sparse[name.split(sep)[0]]
+                result[name] = joined.join(result[guid_names[name]])
+            elif front:
+                result[name] = sparse[name].values.front(slice(0,len(sparse[name])))
+            else:
+                result[name] = sparse[name].values[:len(sparse[name])]
+        for name in extra:
+            del result[name]
+        return result
+
+    def _storage(self,name):
+        '''the Component queries of name see: the pool of a SharedComponent'''
+        component = self.component_dict[name]
+        if isinstance(component,SharedComponent):
+            return component.pool
+        return component
+
 
 
 
@@ -334,3 +996,648 @@ if __name__ == '__main__':
     #allocator.add(to_add2)
     #allocator._defrag() 
 
+
+    #test saving and loading
+    import os, tempfile
+    fd, path = tempfile.mkstemp(suffix='.ecs')
+    os.close(fd)
+    deleted = allocator.guids[1]
+    allocator.delete(deleted)
+    allocator.save(path)
+    loaded = GlobalAllocator.load(path)
+    assert loaded.guids == allocator.guids, "guids must survive a round trip"
+    assert not loaded.is_alive(deleted) and loaded.is_alive(loaded.guids[0])
+    for name in allocator.names:
+        assert np.all(loaded.component_dict[name][:] == \
+            allocator.component_dict[name][:len(loaded.component_dict[name][:])])
+    guid = loaded.add({'component_1':10,'component_3':(28,29,30),})
+    from guids import index_of
+    assert index_of(guid) == index_of(deleted) and guid != deleted, \
+        "the deleted guid's index is recycled with a new generation"
+    loaded._defrag()
+    from persistence import component_from_header
+    old = component_from_header({'name':'a','dim':[1],'dtype':"'<i4'"})
+    assert not old.track_dirty and not old.double_buffered, \
+        "version 1 component headers have no buffer flags"
+    s1 = next(loaded._allocation_table.slices_from_guid(guid))
+    assert loaded.component_dict['component_1'][s1] == 10
+    os.remove(path)
+
+    #test dirty range tracking
+    d1 = Component('component_1',(1,),np.int32,track_dirty=True)
+    d3 = Component('component_3',(3,),np.int32)
+    allocator = GlobalAllocator([d1,d3],((1,1),(1,0)))
+    guids = [allocator.add({'component_1':x,'component_3':(x,x,x)}) for x in range(4)]
+    guids += [allocator.add({'component_1':x}) for x in range(4)]
+    allocator._defrag()
+    assert d1.dirty_ranges() == [(0,8)], "adds are dirty"
+    d1.clear_dirty()
+    sections = allocator.selectors_from_component_query(('component_3',))
+    assert d1.dirty_ranges() == [], "reads are not dirty"
+    sections = allocator.selectors_from_component_query(('component_1','component_3'),
+                                                        writes=('component_1',))
+    assert d1.dirty_ranges() == [(0,4)], "declared writes are dirty"
+    d1.clear_dirty()
+    d1.mark_dirty(slice(1,2))
+    d1.mark_dirty(slice(2,4))
+    d1.mark_dirty(6)
+    assert d1.dirty_ranges() == [(1,4),(6,7)]
+    d1.clear_dirty()
+    from components import MAX_DIRTY_RANGES
+    scratch = Component('scratch',(1,),np.int32,size=4*MAX_DIRTY_RANGES,track_dirty=True)
+    for frame in range(1000):
+        scratch[5:10] = frame
+        scratch[7] = frame
+    assert scratch._dirty == [(5,10)], "repeated writes do not pile up"
+    scratch.generation = 1
+    for row in range(0,4*MAX_DIRTY_RANGES,2):
+        scratch[row] = 0
+    assert len(scratch._dirty) <= MAX_DIRTY_RANGES
+    assert scratch.dirty_ranges() == [(0,4*MAX_DIRTY_RANGES-1)]
+    assert scratch.changed_since(scratch.generation)[:2] == [(0,1),(2,3)], \
+        "stamps stay exact"
+    scratch.clear_dirty()
+    scratch[np.array([901,3,900,-1])] = 1
+    assert scratch.dirty_ranges() == [(3,4),(900,902),(len(scratch[:])-1,len(scratch[:]))], \
+        "scattered writes stay partial"
+    scratch.clear_dirty()
+    scratch[np.zeros(len(scratch[:]),dtype=bool)] = 0 #a mask of no rows
+    scratch[np.zeros(0,dtype=np.intp)] = 0
+    assert scratch.dirty_ranges() == []
+    allocator.delete(guids[1])
+    allocator._defrag()
+    assert d1.dirty_ranges() == [(1,7)], "defrag moves are dirty"
+    d1.clear_dirty()
+    hero = allocator.accessor_from_guid(guids[3])
+    int(hero.component_1)
+    assert d1.dirty_ranges() == [], "accessor reads are not dirty"
+    hero.component_1 += 1
+    row = next(allocator._allocation_table.slices_from_guid(guids[3])).start
+    assert d1.dirty_ranges() == [(row,row+1)], "augmented assignment is dirty"
+    d1.clear_dirty()
+    hero.component_1[...] = 0
+    hero.mark_dirty('component_1')
+    assert d1.dirty_ranges() == [(row,row+1)]
+    del hero
+
+    #test replicating through deltas
+    def make_allocator():
+        return GlobalAllocator([Component('component_1',(1,),np.int32,track_dirty=True),
+                                Component('component_3',(3,),np.int32)],
+                               ((1,1),(1,0)))
+    source, replica = make_allocator(), make_allocator()
+    def in_sync():
+        if source.guids != replica.guids:
+            return False
+        for name in source.names:
+            for guid in source.guids:
+                s1 = list(source._allocation_table.slices_from_guid(guid))
+                s2 = list(replica._allocation_table.slices_from_guid(guid))
+                if s1 != s2 or np.any(source.component_dict[name][s1[source.names.index(name)]] !=
+                                      replica.component_dict[name][s2[source.names.index(name)]]):
+                    return False
+        return True
+    guids = [source.add({'component_1':x,'component_3':(x,x,x)}) for x in range(4)]
+    guids += [source.add({'component_1':x}) for x in range(4)]
+    source._defrag()
+    replica.apply_delta(source.delta_since(0))
+    generation = source.generation
+    assert in_sync(), "full delta replicates"
+    source.delete(guids[1])
+    source.delete(guids[6])
+    guids.append(source.add({'component_1':9,'component_3':(9,9,9)}))
+    source._defrag()
+    transient = source.add({'component_1':10})
+    source._defrag()
+    source.delete(transient)
+    source._defrag()
+    sections = source.selectors_from_component_query(('component_1',),
+                                                     writes=('component_1',))
+    sections['component_1'][:] += 100
+    delta = source.delta_since(generation)
+    generation = source.generation
+    replica.apply_delta(delta)
+    assert in_sync(), "incremental delta replicates"
+    assert transient not in replica.guids
+    assert source.delta_since(generation) and in_sync()
+
+    #test mirroring a defrag from the layout journal
+    mirror = {name:source.component_dict[name][:].copy() for name in source.names}
+    source.subscribe_layout(lambda generation,journal: replay_layout_moves(journal,mirror))
+    for guid in source.guids[::3]:
+        source.delete(guid)
+    source._defrag()
+    for name in source.names:
+        used = source._allocation_table.starts[-1][source.names.index(name)]
+        assert np.all(mirror[name][:used] == source.component_dict[name][:used]), \
+            "mirror must match after replaying journal"
+
+    #test double buffering
+    d1 = Component('component_1',(1,),np.int32,double_buffered=True)
+    d3 = Component('component_3',(3,),np.int32)
+    allocator = GlobalAllocator([d1,d3],((1,1),(1,0)))
+    guids = [allocator.add({'component_1':x,'component_3':(x,x,x)}) for x in range(4)]
+    allocator._defrag()
+    query = ('component_1',)
+    back = allocator.selectors_from_component_query(query)['component_1']
+    back += 10
+    front = allocator.selectors_from_component_query(query,front=True)['component_1']
+    assert np.all(front == np.arange(4)) and not front.flags.writeable
+    allocator.swap()
+    front = allocator.selectors_from_component_query(query,front=True)['component_1']
+    assert np.all(front == np.arange(4)+10), "swap shows the written frame"
+    for frame in range(3):
+        back = allocator.selectors_from_component_query(query)['component_1']
+        back += 1
+        allocator.swap()
+    front = allocator.selectors_from_component_query(query,front=True)['component_1']
+    assert np.all(front == np.arange(4)+13), "read-modify-write keeps every frame"
+    back = allocator.selectors_from_component_query(query)['component_1']
+    back[:] = 0
+    allocator.swap(sync=False)
+    back = allocator.selectors_from_component_query(query)['component_1']
+    assert np.all(back == np.arange(4)+13), "without sync, back is the frame before"
+    back[:] = np.arange(4)+10
+    allocator.swap()
+    dirty = Component('dirty',(1,),np.int32,size=8,track_dirty=True,
+                      double_buffered=True)
+    dirty.write_all(slice(0,8),np.arange(8))
+    dirty.generation = 1 #as GlobalAllocator.swap does
+    dirty.swap(sync=True)
+    dirty[2:4] = 50
+    dirty._front[6] = -1 #the next back buffer
+    dirty.swap(sync=True)
+    assert dirty[:].tolist() == [0,1,50,50,4,5,-1,7], "only written rows are synced"
+    allocator.delete(guids[0])
+    allocator._defrag()
+    front = allocator.selectors_from_component_query(query,front=True)['component_1']
+    assert np.all(front == np.arange(1,4)+10), "front is defragged with back"
+
+    #test accessors follow the layout and are not kept alive
+    import gc
+    hero = allocator.accessor_from_guid(guids[2])
+    assert allocator.accessor_from_guid(guids[2]) is hero
+    view = hero.component_1
+    assert hero.component_1 is view, "views are cached"
+    allocator.delta_since(0)
+    assert hero.component_1 is view, "taking a delta does not move rows"
+    allocator.delete(guids[1])
+    allocator._defrag()
+    assert hero.component_1 is not view and hero.component_1 == 12
+    hero.component_3 = (7,8,9)
+    assert tuple(hero.component_3[0]) == (7,8,9)
+    del hero, view
+    gc.collect()
+    assert not len(allocator._GlobalAllocator__accessors)
+
+    #test gathering and scattering through an EntitySet
+    units = allocator.entity_set(guids[2:4])
+    units.component_1 += 100
+    assert np.all(units.component_1 == (112,113))
+    assert units.component_3.shape == (2,3)
+    rows = units.rows('component_1')
+    allocator.delta_since(0)
+    assert units.rows('component_1') is rows, "deltas keep row indices"
+    allocator.add({'component_1':0,'component_3':(0,0,0)})
+    allocator._defrag()
+    units.component_3 = ((1,1,1),(2,2,2))
+    assert tuple(allocator.accessor_from_guid(guids[3]).component_3[0]) == (2,2,2)
+
+    #test mapping rows back to guids
+    query = ('component_1','guid__to__component_1')
+    sections = allocator.selectors_from_component_query(query)
+    found = sections['guid__to__component_1'][sections['component_1'] > 100]
+    assert sorted(found) == sorted(guids[2:4]), "rows map back to their guids"
+    index = sections['guid__to__component_1']
+    allocator.delete(guids[3])
+    sections = allocator.selectors_from_component_query(query)
+    assert guids[3] not in sections['guid__to__component_1'].tolist() and \
+        -1 in sections['guid__to__component_1'].tolist(), \
+        "deleted guids are -1 before the next _defrag"
+    assert sections['guid__to__component_1'] is index, "patched, not rebuilt"
+    allocator._defrag()
+    del guids[3]
+    guids.append(allocator.add({'component_1':113}))
+    allocator._defrag()
+
+    #test vectorized deletes
+    before = set(allocator.guids)
+    deleted = allocator.delete_where(('component_1',),lambda c1: c1 > 100)
+    assert sorted(deleted) == sorted(guids[2:4])
+    allocator._defrag()
+    assert set(allocator.guids) == before - set(guids[2:4])
+    from sparse import SparseComponent
+    allocator = GlobalAllocator([Component('component_1',(1,),np.int32)],((1,),),
+        sparse_components=[SparseComponent('burning',(1,),np.float32)])
+    guids = [allocator.add({'component_1':x}) for x in range(10)]
+    allocator._defrag()
+    for guid in guids[::2]:
+        allocator.sparse_dict['burning'].insert(guid,1.)
+    deleted = allocator.delete_where(('component_1',),lambda c1: c1 % 3 == 0)
+    assert deleted.tolist() == guids[::3] and deleted.dtype == np.int64
+    assert not any(allocator.is_alive(g) for g in guids[::3])
+    assert len(allocator.sparse_dict['burning']) == 3, "0 and 6 lost their values"
+    assert allocator.entity_counts()['tombstoned'] == 4
+    allocator._defrag()
+    assert allocator.guids == tuple(g for g in guids if g not in guids[::3])
+
+    #test reducing rows to one value per guid
+    d1 = Component('component_1',(1,),np.int32)
+    d2 = Component('component_2',(2,),np.int32)
+    allocator = GlobalAllocator([d1,d2],((1,1),))
+    allocator.add({'component_1':0,'component_2':((1,10),(2,20))})
+    allocator.add({'component_1':1,'component_2':((3,30),(4,40),(5,50))})
+    allocator._defrag()
+    query = ('component_2','component_1__to__component_2','component_2__offsets')
+    sections = allocator.selectors_from_component_query(query)
+    assert list(sections['component_1__to__component_2']) == [0,0,1,1,1]
+    assert sections['component_1__to__component_2'].dtype == np.int32
+    sums = np.add.reduceat(sections['component_2'],sections['component_2__offsets'])
+    assert sums.tolist() == [[3,30],[12,120]]
+    owned = GlobalAllocator([Component('component_1',(1,),np.int32),
+                             Component('component_2',(2,),np.int32)],((1,1),))
+    first, second, third = [owned.add({'component_1':x,'component_2':[(x,x)]*x})
+                            for x in (2,3,1)]
+    owned._defrag()
+    owners = ('component_2','guid__to__component_2')
+    assert owned.selectors_from_component_query(owners)['guid__to__component_2'].tolist() \
+        == [first]*2 + [second]*3 + [third]
+    owned.delete(second)
+    owned.delete_where(('component_1',),lambda c1: c1 == 1)
+    assert owned.selectors_from_component_query(owners)['guid__to__component_2'].tolist() \
+        == [first]*2 + [-1]*4
+
+    #test instrumentation
+    assert allocator.stats is None
+    stats = allocator.enable_stats()
+    allocator.add({'component_1':2,'component_2':((6,60),(7,70),(8,80),(9,90))})
+    allocator.delete(allocator.guids[0])
+    assert allocator.entity_counts() == {'live':1,'tombstoned':1,'staged':1}
+    allocator._defrag()
+    assert allocator.entity_counts() == {'live':2,'tombstoned':0,'staged':0}
+    allocator.selectors_from_component_query(query)
+    allocator.selectors_from_component_query(query)
+    report = stats.report(allocator)
+    assert report['defrags'] == 1 and len(stats.history) == 1
+    assert (report['query_misses'],report['query_hits']) == (1,1)
+    #guid 2's rows moved down over guid 1's: 1 row of c1, 3 rows of c2
+    assert report['bytes_moved'] == {'component_1':4,'component_2':24}
+    assert report['resizes'] == {'component_2':1}
+    assert all(report['seconds'][phase] >= 0 for phase in ('stage','compress','move','add'))
+    assert stats.slowest()[0]['generation'] == allocator.generation
+    allocator.disable_stats()
+    allocator.selectors_from_component_query(query)
+    assert stats.query_hits == 1
+
+    #test memory report
+    guids = allocator.guids
+    allocator.delete(guids[0])
+    report = allocator.memory_report()
+    c2 = report['components']['component_2']
+    assert c2['used_rows'] == 7 and c2['tombstoned_rows'] == 3
+    assert c2['capacity_rows'] == c2['used_rows'] + c2['slack_rows']
+    assert c2['tombstoned_bytes'] == 3*2*4
+    assert c2['sections'] == {'1,1':7}
+    assert report['entities'] == {'live':1,'tombstoned':1,'staged':0}
+    assert report['table']['rows'] == 2 and report['table']['python_bytes'] > 0
+    sampled = allocator.memory_report(sample=1)['table']
+    assert sampled['sampled'] and sampled['python_bytes'] > 0
+    import json
+    json.dumps(allocator.memory_report(sample=1)) #cheap enough to export often
+
+    #test frame profiler
+    import json
+    profiler = allocator.enable_profiler(capacity=8)
+    stats = allocator.enable_stats()
+    profiler.next_frame()
+    allocator._defrag()
+    allocator.selectors_from_component_query(query)
+    with profiler.span('game logic'):
+        pass
+    profiler.next_frame()
+    names = [span.name for span in profiler.spans]
+    assert names == ['stage','compress','move','add','_defrag','query',
+                     'game logic','frame'], names
+    assert all(span.frame == 1 for span in profiler.spans)
+    assert stats.defrags == 1 and stats.query_misses == 1
+    trace = json.loads(json.dumps(profiler.chrome_trace()))
+    assert len(trace['traceEvents']) == 8
+    assert trace['traceEvents'][-1]['ph'] == 'X'
+    for frame in range(5):
+        allocator.selectors_from_component_query(query)
+    assert len(profiler.spans) == 8, 'ring buffer keeps the newest spans'
+    allocator.disable_profiler()
+    allocator.disable_stats()
+    assert allocator._probes == ()
+
+    #test prefabs
+    d1 = Component('component_1',(1,),np.int32)
+    d2 = Component('component_2',(2,),np.int32)
+    allocator = GlobalAllocator([d1,d2],((1,1),(1,0)))
+    allocator.register_prefab('pair',{'component_1':7,'component_2':((1,2),(3,4))})
+    lone = allocator.add({'component_1':1,'component_2':((0,0),)})
+    spawned = allocator.spawn('pair',3,overrides={'component_1':(10,11,12)})
+    other = allocator.add({'component_1':2,'component_2':((0,0),)})
+    rows = np.arange(12,dtype=np.int32).reshape(6,2)
+    more = allocator.spawn('pair',2,overrides={'component_2':rows[:4]})
+    assert allocator.entity_counts()['staged'] == 7
+    allocator._defrag()
+    for guid, c1 in zip(spawned,(10,11,12)):
+        s1, s2 = allocator._allocation_table.slices_from_guid(guid)
+        assert d1[s1] == c1 and d2[s2].tolist() == [[1,2],[3,4]]
+    s1, s2 = allocator._allocation_table.slices_from_guid(more[1])
+    assert d1[s1] == 7 and d2[s2].tolist() == [[4,5],[6,7]]
+    s1, s2 = allocator._allocation_table.slices_from_guid(other)
+    assert d1[s1] == 2 and d2[s2].tolist() == [[0,0]]
+    assert allocator.entity_counts() == {'live':7,'tombstoned':0,'staged':0}
+
+    #test shared components
+    from components import SharedComponent
+    from kernels import take_rows
+    mesh = SharedComponent('mesh',(2,),np.float32)
+    verts = Component('verts',(2,),np.float32)
+    pos = Component('pos',(2,),np.float32)
+    allocator = GlobalAllocator([mesh,verts,pos],((1,1,1),(0,0,1)))
+    square = ((0,0),(1,0),(1,1),(0,1))
+    triangle = ((0,0),(1,0),(0,1))
+    shapes = [square,triangle,square,square,triangle]
+    guids = [allocator.add({'mesh':shape,'verts':np.zeros((len(shape),2)),
+                            'pos':(i,0)}) for i, shape in enumerate(shapes)]
+    allocator.add({'pos':(9,9)})
+    allocator.register_prefab('tri',{'mesh':triangle,'verts':[(0,0)]*3,'pos':(0,0)})
+    allocator.spawn('tri',2)
+    allocator._defrag()
+    assert mesh.used == 7 and mesh[:7].tolist() == [0,1,0,0,1,1,1], \
+        "equal values share one block"
+    query = ('verts','mesh','pos','mesh__to__verts','pos__to__verts')
+    sections = allocator.selectors_from_component_query(query)
+    assert len(sections['mesh']) == 7, "the section of a shared component is its pool"
+    rows = sections['mesh__to__verts']
+    assert rows.tolist() == [0,1,2,3,4,5,6] + [0,1,2,3]*2 + [4,5,6]*3
+    sections['verts'][:] = take_rows(sections['mesh'],rows)
+    sections['verts'] += sections['pos'][sections['pos__to__verts']]
+    s1, s2, s3 = allocator._allocation_table.slices_from_guid(guids[3])
+    assert verts[s2].tolist() == [[3,0],[4,0],[4,1],[3,1]]
+    allocator.delete(guids[0])
+    allocator._defrag()
+    rows = allocator.selectors_from_component_query(query)['mesh__to__verts']
+    assert rows.tolist() == [4,5,6] + [0,1,2,3]*2 + [4,5,6]*3, \
+        "defrag moves ids, not meshes"
+    report = allocator.memory_report()['components']['mesh']
+    assert report['used_rows'] == 6 and report['extra_bytes'] >= 7*2*4
+    fd, path = tempfile.mkstemp(suffix='.ecs')
+    os.close(fd)
+    allocator.save(path)
+    loaded = GlobalAllocator.load(path)
+    assert np.all(loaded.selectors_from_component_query(query)['mesh__to__verts'] == rows)
+    assert loaded.component_dict['mesh'].intern(square) == 0
+    os.remove(path)
+    replica = GlobalAllocator([SharedComponent('mesh',(2,),np.float32),
+                               Component('verts',(2,),np.float32),
+                               Component('pos',(2,),np.float32)],((1,1,1),(0,0,1)))
+    replica.apply_delta(allocator.delta_since(0))
+    assert replica.component_dict['mesh'].block(1).tolist() == list(map(list,triangle))
+
+    #test tag components
+    from components import TagComponent
+    enemy = TagComponent('enemy')
+    c1 = Component('component_1',(1,),np.int32)
+    allocator = GlobalAllocator([c1,enemy],((1,1),(1,0)))
+    guids = [allocator.add({'component_1':x,'enemy':True} if x%2 else
+                           {'component_1':x}) for x in range(6)]
+    allocator._defrag()
+    query = ('component_1','enemy')
+    sections = allocator.selectors_from_component_query(query)
+    assert sorted(sections['component_1']) == [1,3,5]
+    assert sections['enemy'].tolist() == [True]*3 and sections['enemy'].strides == (0,)
+    stats = allocator.enable_stats()
+    allocator.delete(guids[1])
+    allocator._defrag()
+    assert 'enemy' not in stats.report()['bytes_moved']
+    assert sorted(allocator.selectors_from_component_query(query)['component_1']) == [3,5]
+    report = allocator.memory_report()['components']['enemy']
+    assert report['used_rows'] == 2 and report['capacity_bytes'] == 0
+    assert allocator.accessor_from_guid(guids[3]).enemy.tolist() == [True]
+    fd, path = tempfile.mkstemp(suffix='.ecs')
+    os.close(fd)
+    allocator.save(path)
+    loaded = GlobalAllocator.load(path)
+    assert isinstance(loaded.component_dict['enemy'],TagComponent)
+    assert len(loaded.selectors_from_component_query(query)['enemy']) == 2
+    os.remove(path)
+
+    #test sparse components
+    from sparse import SparseComponent
+    def make_allocator():
+        return GlobalAllocator([Component('component_1',(1,),np.int32),
+                                Component('component_3',(3,),np.int32)],
+                               ((1,1),(1,0)),
+                               sparse_components=[SparseComponent('burning',(1,),np.float32)])
+    allocator = make_allocator()
+    burning = allocator.sparse_dict['burning']
+    guids = [allocator.add({'component_1':x,'component_3':(x,x,x)}) for x in range(3)]
+    guids.append(allocator.add({'component_1':3,'burning':.5}))
+    allocator._defrag()
+    burning.insert(guids[1],2.)
+    assert allocator._allocation_table.active_class_ids == ((1,1),(1,0)), \
+        "sparse components make no classes"
+    query = ('component_1','burning','burning__to__component_1')
+    sections = allocator.selectors_from_component_query(query)
+    rows = sections['burning__to__component_1']
+    assert rows.tolist() == [-1,1,-1,0] and 'guid__to__component_1' not in sections
+    assert sections['burning'][rows[rows >= 0]].tolist() == [2.,.5]
+    sections['burning'][rows[rows >= 0]] -= .5
+    assert burning.get(guids[3]) == 0.
+    allocator.delete(guids[1])
+    assert guids[1] not in burning and len(burning) == 1
+    allocator._defrag()
+    rows = allocator.selectors_from_component_query(query)['burning__to__component_1']
+    assert rows.tolist() == [-1,-1,0]
+    assert allocator.memory_report()['sparse']['burning']['rows'] == 1
+    fd, path = tempfile.mkstemp(suffix='.ecs')
+    os.close(fd)
+    allocator.save(path)
+    loaded = GlobalAllocator.load(path)
+    assert guids[3] in loaded.sparse_dict['burning'] and guids[0] not in loaded.sparse_dict['burning']
+    os.remove(path)
+    replica = make_allocator()
+    replica.apply_delta(allocator.delta_since(0))
+    generation = allocator.generation
+    allocator.sparse_dict['burning'].insert(guids[0],9.)
+    replica.apply_delta(allocator.delta_since(generation))
+    assert replica.selectors_from_component_query(query)['burning__to__component_1'].tolist() == [1,-1,0]
+
+    #test dormant sections
+    def make_allocator():
+        return GlobalAllocator([Component('component_1',(1,),np.int32,track_dirty=True),
+                                Component('component_3',(3,),np.int32)],
+                               ((1,1),(1,0)))
+    allocator, replica = make_allocator(), make_allocator()
+    guids = [allocator.add({'component_1':x,'component_3':(x,x,x)}) for x in range(4)]
+    guids += [allocator.add({'component_1':x}) for x in range(4,6)]
+    allocator._defrag()
+    replica.apply_delta(allocator.delta_since(0))
+    generation = allocator.generation
+    mirror = {name:np.array(allocator.component_dict[name][:]) for name in allocator.names}
+    journals = []
+    def replay(generation,journal):
+        journals.append(journal)
+        replay_layout_moves(journal,mirror)
+    allocator.subscribe_layout(replay)
+    allocator.deactivate(guids[:3] + guids[4:5])
+    assert allocator.is_dormant(guids[0]) and not allocator.is_dormant(guids[3])
+    allocator._defrag()
+    c1 = allocator.component_dict['component_1']
+    sections = allocator.selectors_from_component_query(('component_1',))
+    assert sorted(sections['component_1']) == [3,5], "queries skip dormant guids"
+    assert c1[:6].tolist() == [3,5,0,1,2,4], "dormant sections follow every active one"
+    assert mirror['component_1'][:6].tolist() == c1[:6].tolist(), \
+        "moves between sections are journalled"
+    assert np.all(mirror['component_3'][:4] == allocator.component_dict['component_3'][:4])
+    assert len([m for m in journals[-1] if m.component == 'component_1']) == 6, \
+        "adjacent rows move as blocks: 2 parked, 2 compress moves, 2 unparked"
+    assert allocator.accessor_from_guid(guids[1]).component_3.tolist() == [[1,1,1]]
+    replica.apply_delta(allocator.delta_since(generation))
+    generation = allocator.generation
+    assert replica.guids == allocator.guids and replica.is_dormant(guids[2])
+    assert np.all(replica.component_dict['component_1'][:6] == c1[:6])
+    allocator.activate(guids[1:2])
+    allocator.delete(guids[2])
+    allocator._defrag()
+    assert mirror['component_1'][:5].tolist() == c1[:5].tolist()
+    allocator.unsubscribe_layout(replay)
+    sections = allocator.selectors_from_component_query(('component_1','component_3'))
+    assert sorted(sections['component_1']) == [1,3]
+    assert c1[:5].tolist() == [3,1,5,0,4] and allocator.is_alive(guids[1])
+    replica.apply_delta(allocator.delta_since(generation))
+    assert replica.guids == allocator.guids and not replica.is_alive(guids[2])
+    fd, path = tempfile.mkstemp(suffix='.ecs')
+    os.close(fd)
+    allocator.save(path)
+    loaded = GlobalAllocator.load(path)
+    assert loaded.is_dormant(guids[0]) and not loaded.is_dormant(guids[1])
+    assert sorted(loaded.selectors_from_component_query(('component_1',))['component_1']) == [1,3,5]
+    os.remove(path)
+    #guids added, spawned or woken in the same frame are added dormant
+    generation = allocator.generation
+    allocator.hibernate([guids[3]])
+    allocator._defrag()
+    allocator.register_prefab('one',{'component_1':0,'component_3':(0,0,0)})
+    fresh = allocator.add({'component_1':20,'component_3':(20,20,20)})
+    batch = allocator.spawn('one',4,overrides={'component_1':(30,31,32,33)})
+    allocator.wake([guids[3]])
+    allocator.deactivate([fresh,batch[1],batch[3],guids[3]])
+    assert allocator.is_dormant(fresh) and not allocator.is_dormant(batch[0])
+    allocator._defrag()
+    for guid in (fresh,batch[1],batch[3],guids[3]):
+        assert allocator.is_dormant(guid), "deactivated before its first _defrag"
+    assert not allocator.is_dormant(batch[2])
+    sections = allocator.selectors_from_component_query(('component_1','component_3'))
+    assert sorted(sections['component_1']) == [1,30,32]
+    for guid, x in zip((fresh,batch[1],batch[3],guids[3]),(20,31,33,3)):
+        s1, s3 = allocator._allocation_table.slices_from_guid(guid)
+        assert c1[s1] == x and allocator.component_dict['component_3'][s3].tolist() == \
+            [[x,x,x] if guid != batch[1] and guid != batch[3] else [0,0,0]]
+    replica.apply_delta(allocator.delta_since(generation))
+    assert replica.guids == allocator.guids and replica.is_dormant(fresh)
+    assert np.all(replica.component_dict['component_1'][:len(allocator.guids)] ==
+                  c1[:len(allocator.guids)])
+
+    #test hibernation
+    c1 = Component('component_1',(1,),np.int32)
+    c2 = Component('component_2',(2,),np.int32)
+    allocator = GlobalAllocator([c1,c2],((1,1),(1,0)))
+    guids = [allocator.add({'component_1':x,'component_2':[(x,x)]*(x%3+1)})
+             for x in range(100)]
+    guids += [allocator.add({'component_1':x}) for x in range(100,110)]
+    allocator._defrag()
+    cold = guids[10:90] + guids[105:]
+    allocator.hibernate(cold)
+    assert allocator.is_hibernating(guids[50]) and allocator.is_alive(guids[50])
+    allocator._defrag()
+    assert len(allocator.guids) == 25 and allocator._allocation_table.starts[-1][0] == 25
+    report = allocator.memory_report()['hibernated']
+    assert report['entities'] == 85
+    assert report['compressed_bytes'] < 85*4 + 160*8, "archive is compressed"
+    fd, path = tempfile.mkstemp(suffix='.ecs')
+    os.close(fd)
+    allocator.save(path)
+    loaded = GlobalAllocator.load(path)
+    os.remove(path)
+    for world in (allocator,loaded):
+        world.wake(guids[40:60])
+        world.delete(guids[70])
+        world._defrag()
+        assert not world.is_alive(guids[70]) and len(world.archive) == 64
+        for x in (40,59):
+            s1, s2 = world._allocation_table.slices_from_guid(guids[x])
+            assert world.component_dict['component_1'][s1] == x
+            assert world.component_dict['component_2'][s2].tolist() == [[x,x]]*(x%3+1)
+        world.wake(cold[:30] + cold[50:60] + cold[61:])
+        world._defrag()
+        assert len(world.archive) == 0 and not world.archive.chunks
+        assert sorted(world.component_dict['component_1'][:109]) == \
+            [x for x in range(110) if x != 70]
+
+    #test frame history and rollback
+    c1 = Component('component_1',(1,),np.int32,track_dirty=True)
+    c2 = Component('component_2',(2,),np.float32)
+    allocator = GlobalAllocator([c1,c2],((1,1),(1,0)))
+    guids = [allocator.add({'component_1':x,'component_2':[(x,x)]*(x%2+1)})
+             for x in range(6)]
+    history = allocator.enable_history(frames=3)
+    allocator.record_frame() #frame 0
+    assert history.count == 1 and len(allocator.guids) == 6
+    c2[:9] += 1
+    allocator.record_frame() #frame 1, same layout
+    assert history.layouts[0] is history.layouts[1], "layouts are shared"
+    allocator.delete(guids[1])
+    new = allocator.add({'component_1':10})
+    allocator.record_frame() #frame 2, after a _defrag moved rows
+    assert history.layouts[2] is not history.layouts[1]
+    c1[:6] *= 2
+    allocator.rollback(0)
+    assert c1[:6].tolist() == [0,2,3,4,5,10]
+    guids.append(allocator.add({'component_1':11}))
+    allocator.rollback(1) #back across the _defrag and the pending add
+    assert allocator.guids == tuple(guids[:6]) and not allocator.is_alive(new)
+    assert allocator.is_alive(guids[1]) and not allocator.is_alive(guids[6])
+    assert c1[:6].tolist() == list(range(6))
+    assert c2[:9].tolist() == [[x+1.,x+1.] for x in (0,1,1,2,3,3,4,5,5)]
+    assert history.count == 2
+    accessor = allocator.accessor_from_guid(guids[3])
+    assert accessor.component_1 == 3 and accessor.component_2.tolist() == [[4.,4.],[4.,4.]]
+    allocator.rollback(1)
+    assert c2[:9].tolist() == [[x,x] for x in (0,1,1,2,3,3,4,5,5)]
+    assert allocator.memory_report()['history']['frames'] == 1
+    for frame in range(5): #wraps around the ring
+        c1[:6] += 1
+        allocator.add({'component_1':frame+20})
+        allocator.record_frame()
+    allocator.rollback(2)
+    assert c1[:9].tolist() == [3,4,5,6,7,8,20,21,22] and len(allocator.guids) == 9
+    partial = allocator.enable_history(('component_1',),frames=2)
+    allocator.record_frame()
+    allocator.add({'component_1':30})
+    allocator._defrag()
+    try:
+        allocator.rollback(0)
+    except AssertionError:
+        pass
+    else:
+        raise AssertionError("rollback across _defrag needs every Component")
+    history = allocator.enable_history(frames=2)
+    allocator.record_frame()
+    asleep = allocator.guids[0]
+    allocator.hibernate([asleep])
+    allocator._defrag()
+    try:
+        allocator.rollback(0)
+    except AssertionError:
+        pass
+    else:
+        raise AssertionError("rollback across hibernate is refused")
+    assert asleep not in allocator.guids, "a refused rollback changes nothing"
+    allocator.wake([asleep])
+    allocator._defrag()
+    assert asleep in allocator.guids and len(allocator.archive) == 0
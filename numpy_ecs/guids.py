@@ -0,0 +1,214 @@
+'''
+Generational guid handles.
+
+A guid is an index and a generation packed into one int64:
+
+    guid = index | generation << INDEX_BITS
+
+Indices are handed out densely and recycled from a free list, so arrays
+indexed by `index_of(guid)` stay as small as the live population.  Deleting a
+guid bumps the generation stored for its index, so a stale guid (one that was
+deleted, whose index may since have been reused) is detected with one array
+lookup.  Indices of deleted guids only return to the free list when recycle
+is called, which the allocator does once the Table no longer holds them.
+
+This file is part of Numpy-ECS.
+Copyright (C) 2016 Elliot Hallmark (permafacture@gmail.com)
+
+Numpy-ECS is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 2 of the License, or
+(at your option) any later version.
+
+Data Oriented Python is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+from __future__ import absolute_import, division, print_function
+import sys
+#python version compatability
+if sys.version_info < (3,0):
+    from future_builtins import zip, map
+
+import numpy as np
+
+INDEX_BITS = 32
+INDEX_MASK = (1 << INDEX_BITS) - 1
+FIRST_GENERATION = 1 #so that no handed out guid is 0
+
+#index states
+ALIVE, PENDING, FREE = 0, 1, 2
+
+def make_guid(index,generation):
+    return index | generation << INDEX_BITS
+
+def index_of(guid):
+    '''the dense index of guid.  Works on arrays of guids too.'''
+    return guid & INDEX_MASK
+
+def generation_of(guid):
+    return guid >> INDEX_BITS
+
+class GuidPool(object):
+    '''hands out guids and recycles the indices of released ones'''
+
+    def __init__(self):
+        self.size = 0 #indices ever used
+        self.generations = np.zeros(0,dtype=np.int64) #current, per index
+        self.states = np.zeros(0,dtype=np.int8)
+        self.free = [] #recycled indices. may hold stale entries, see acquire
+        self.pending = [] #released, not yet recycled
+
+    def _grow(self,size):
+        if size > len(self.generations):
+            capacity = max(size,2*len(self.generations),16)
+            generations = np.full(capacity,FIRST_GENERATION,dtype=np.int64)
+            generations[:self.size] = self.generations[:self.size]
+            states = np.full(capacity,FREE,dtype=np.int8)
+            states[:self.size] = self.states[:self.size]
+            self.generations, self.states = generations, states
+        self.size = max(self.size,size)
+
+    def acquire(self):
+        '''a new guid'''
+        free, states = self.free, self.states
+        while free:
+            index = free.pop()
+            if states[index] == FREE: #else it was claimed since recycling
+                break
+        else:
+            index = self.size
+            self._grow(index + 1)
+        self.states[index] = ALIVE #states may have grown
+        return make_guid(index,int(self.generations[index]))
+
+    def claim(self,guid):
+        '''mark a guid made elsewhere (ie: by another allocator) alive'''
+        assert 0 <= guid < 1 << 63, 'guids must fit in an int64'
+        index, generation = index_of(guid), generation_of(guid)
+        if index >= self.size:
+            old = self.size
+            self._grow(index + 1)
+            self.free.extend(range(old,index))
+        else:
+            assert not self.is_alive(guid), 'guid %s is already alive'%(guid,)
+        self.generations[index] = generation
+        self.states[index] = ALIVE
+
+    def is_alive(self,guid):
+        index = index_of(guid)
+        return (index < self.size and self.states[index] == ALIVE and
+                self.generations[index] == generation_of(guid))
+
+    def alive(self,guids):
+        '''vectorized is_alive for an int64 array of guids'''
+        guids = np.asarray(guids,dtype=np.int64)
+        indices = index_of(guids)
+        result = indices < self.size
+        indices = np.where(result,indices,0)
+        if self.size:
+            result &= self.states[indices] == ALIVE
+            result &= self.generations[indices] == generation_of(guids)
+        return result
+
+    def release(self,guid):
+        '''make guid stale.  Its index is reused after the next recycle.'''
+        assert self.is_alive(guid), 'guid %s is not alive'%(guid,)
+        index = index_of(guid)
+        self.generations[index] += 1
+        self.states[index] = PENDING
+        self.pending.append(index)
+
+    def release_many(self,guids):
+        '''release every guid of an int64 array at once'''
+        guids = np.asarray(guids,dtype=np.int64)
+        assert np.all(self.alive(guids)), 'guids must be alive'
+        indices = index_of(guids)
+        assert len(np.unique(indices)) == len(indices), 'guids must differ'
+        self.generations[indices] += 1
+        self.states[indices] = PENDING
+        self.pending.extend(indices.tolist())
+
+    def recycle(self):
+        '''make the indices of released guids available to acquire'''
+        states = self.states
+        for index in self.pending:
+            if states[index] == PENDING:
+                states[index] = FREE
+                self.free.append(index)
+        self.pending = []
+
+    @property
+    def live(self):
+        return int(np.count_nonzero(self.states[:self.size] == ALIVE))
+
+    def blocks(self):
+        '''[(key, array),...] for saving with persistence.write_blocks'''
+        self.free = [i for i in self.free if self.states[i] == FREE]
+        return [('guids/generations',self.generations[:self.size]),
+                ('guids/states',self.states[:self.size]),
+                ('guids/free',np.array(self.free,dtype=np.int64)),
+                ('guids/pending',np.array(self.pending,dtype=np.int64))]
+
+    def restore(self,generations,states,free,pending):
+        '''inverse of blocks'''
+        self.size = 0
+        self.generations = np.zeros(0,dtype=np.int64)
+        self._grow(len(generations))
+        self.generations[:self.size] = generations
+        self.states[:self.size] = states
+        self.free = free.tolist()
+        self.pending = pending.tolist()
+
+    def rebuild(self,guids):
+        '''start over with exactly guids alive, ie: from files written
+        before guids were generational'''
+        self.__init__()
+        for guid in guids:
+            self.claim(guid)
+
+    def __repr__(self):
+        return "<GuidPool: %s live of %s indices>"%(self.live,self.size)
+
+if __name__ == '__main__':
+    pool = GuidPool()
+    a, b, c = pool.acquire(), pool.acquire(), pool.acquire()
+    assert [index_of(g) for g in (a,b,c)] == [0,1,2]
+    assert a == make_guid(0,FIRST_GENERATION) and a != 0
+    pool.release(b)
+    assert not pool.is_alive(b)
+    d = pool.acquire()
+    assert index_of(d) == 3, 'released indices wait for recycle'
+    pool.recycle()
+    e = pool.acquire()
+    assert index_of(e) == 1 and e != b and pool.is_alive(e)
+    assert not pool.is_alive(b), 'stale guid'
+    assert pool.alive([a,b,c,e,make_guid(99,1)]).tolist() == \
+        [True,False,True,True,False]
+
+    #claiming guids made by another pool
+    other = GuidPool()
+    other.claim(e)
+    other.claim(make_guid(4,7))
+    assert other.is_alive(e) and not other.is_alive(make_guid(1,1))
+    assert index_of(other.acquire()) in (0,2,3)
+    other.release(e)
+    other.claim(make_guid(1,5)) #index 1 reused before it was recycled
+    other.recycle()
+    assert index_of(other.acquire()) != 1
+
+    restored = GuidPool()
+    restored.restore(*(array for key,array in pool.blocks()))
+    assert restored.is_alive(e) and not restored.is_alive(b)
+    assert index_of(restored.acquire()) == index_of(pool.acquire())
+
+    many = GuidPool()
+    guids = np.array([many.acquire() for _ in range(6)],dtype=np.int64)
+    many.release_many(guids[[1,4]])
+    assert many.alive(guids).tolist() == [True,False,True,True,False,True]
+    many.recycle()
+    assert sorted(index_of(many.acquire()) for _ in range(2)) == [1,4]
@@ -0,0 +1,183 @@
+'''
+Compressed storage for entities that are out of play for a long time.
+
+    allocator.hibernate(guids)
+    ...
+    allocator.wake(guids)
+
+hibernate gathers the rows of guids out of every Component, compresses them
+column by column (one zlib stream per Component, which compresses far better
+than rows of mixed values) into a chunk of the allocator's Archive, and
+deletes the rows from the Table.  The guids stay alive.  wake decompresses
+each chunk involved once and stages the guids to be added back at the next
+_defrag, with the values they had.
+
+Hibernated entities are in no query, and woken ones come back active (see
+deactivate).  SparseComponent values stay where they are.  Deltas treat
+hibernating as a delete and waking as an add, so replicas do not hold the
+archive, but save does.
+
+This file is part of Numpy-ECS.
+Copyright (C) 2016 Elliot Hallmark (permafacture@gmail.com)
+
+Numpy-ECS is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 2 of the License, or
+(at your option) any later version.
+
+Data Oriented Python is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+from __future__ import absolute_import, division, print_function
+import sys
+#python version compatability
+if sys.version_info < (3,0):
+    from future_builtins import zip, map
+
+import zlib
+import numpy as np
+
+class Chunk(object):
+    '''the entities of one hibernate call'''
+
+    def __init__(self,guids,sizes,columns,level=6):
+        self.guids = list(guids) #None once woken
+        self.shape = sizes.shape
+        #(guids, columns) rows of each guid in each column
+        self._sizes = zlib.compress(sizes.astype(np.int32).tobytes(),level)
+        self.columns = columns #{name: zlib compressed rows}
+        self.live = len(self.guids)
+
+    @property
+    def sizes(self):
+        data = zlib.decompress(self._sizes)
+        return np.frombuffer(data,dtype=np.int32).reshape(self.shape)
+
+    @property
+    def nbytes(self):
+        return (sum(len(data) for data in self.columns.values())
+                + len(self._sizes))
+
+class Archive(object):
+    '''compressed, columnar rows of hibernated guids.  column_types is
+    [(name, dtype, row shape),...] of the Components, in Table order.'''
+
+    def __init__(self,column_types,level=6):
+        self.column_types = tuple(column_types)
+        self.level = level
+        self.chunks = {} #{chunk id: Chunk}
+        self.index = {} #{guid: (chunk id, position in chunk)}
+        self._next_chunk = 0
+
+    def __contains__(self,guid):
+        return guid in self.index
+
+    def __len__(self):
+        return len(self.index)
+
+    @property
+    def nbytes(self):
+        '''compressed bytes held'''
+        return sum(chunk.nbytes for chunk in self.chunks.values())
+
+    def store(self,guids,sizes,columns):
+        '''archive guids, where sizes[i,j] is the rows guids[i] has of
+        column j, and columns is {name: the rows of every guid, in order}'''
+        level = self.level
+        compressed = {name:zlib.compress(np.ascontiguousarray(rows).tobytes(),level)
+                      for name, rows in columns.items() if len(rows)}
+        chunk_id = self._next_chunk
+        self._next_chunk += 1
+        sizes = np.asarray(sizes,dtype=np.int64).reshape(len(guids),-1)
+        self.chunks[chunk_id] = Chunk(guids,sizes,compressed,level)
+        for position, guid in enumerate(guids):
+            assert guid not in self.index, 'guid %s is already hibernating'%(guid,)
+            self.index[guid] = (chunk_id,position)
+
+    def discard(self,guid):
+        '''forget guid, ie: because it was deleted'''
+        chunk_id, position = self.index.pop(guid)
+        self._forget(chunk_id,position)
+
+    def _forget(self,chunk_id,position):
+        chunk = self.chunks[chunk_id]
+        chunk.guids[position] = None
+        chunk.live -= 1
+        if not chunk.live:
+            del self.chunks[chunk_id]
+
+    def take(self,guids):
+        '''remove guids from the archive.  returns [(guid, {name: rows}),...]
+        with only the columns each guid has rows of.  Each chunk is
+        decompressed once.'''
+        by_chunk = {}
+        for guid in guids:
+            chunk_id, position = self.index.pop(guid)
+            by_chunk.setdefault(chunk_id,[]).append((guid,position))
+        result = []
+        for chunk_id, members in by_chunk.items():
+            chunk = self.chunks[chunk_id]
+            sizes = chunk.sizes
+            starts = np.cumsum(sizes,axis=0) - sizes
+            columns = {}
+            for name, dtype, row_shape in self.column_types:
+                if name in chunk.columns:
+                    data = zlib.decompress(chunk.columns[name])
+                    columns[name] = np.frombuffer(data,dtype=dtype).reshape(
+                        (-1,)+row_shape)
+            for guid, position in members:
+                values = {}
+                for j, (name, dtype, row_shape) in enumerate(self.column_types):
+                    size = sizes[position,j]
+                    if size:
+                        start = starts[position,j]
+                        values[name] = columns[name][start:start+size]
+                result.append((guid,values))
+                self._forget(chunk_id,position)
+        return result
+
+    def blocks(self):
+        '''[(key, array),...] for persistence.write_blocks'''
+        blocks = []
+        for chunk_id, chunk in sorted(self.chunks.items()):
+            prefix = 'hibernated/%s/'%(chunk_id,)
+            guids = [-1 if g is None else g for g in chunk.guids]
+            blocks.append((prefix + 'guids',np.array(guids,dtype=np.int64)))
+            blocks.append((prefix + 'sizes',chunk.sizes.astype(np.int64)))
+            for name, data in chunk.columns.items():
+                blocks.append((prefix + 'columns/' + name,
+                               np.frombuffer(data,dtype=np.uint8)))
+        return blocks
+
+    def restore(self,keys,get_block):
+        '''inverse of blocks, given every key of a file and a function
+        returning the block of a key'''
+        self.chunks = {}
+        self.index = {}
+        chunk_ids = sorted({int(key.split('/')[1]) for key in keys
+                            if key.startswith('hibernated/')})
+        for chunk_id in chunk_ids:
+            prefix = 'hibernated/%s/'%(chunk_id,)
+            guids = get_block(prefix + 'guids').tolist()
+            columns = {}
+            for name, dtype, row_shape in self.column_types:
+                if prefix + 'columns/' + name in keys:
+                    columns[name] = np.array(get_block(prefix + 'columns/' + name)).tobytes()
+            chunk = Chunk([None if g == -1 else g for g in guids],
+                          np.array(get_block(prefix + 'sizes')),columns,
+                          self.level)
+            chunk.live = sum(g is not None for g in chunk.guids)
+            self.chunks[chunk_id] = chunk
+            for position, guid in enumerate(chunk.guids):
+                if guid is not None:
+                    self.index[guid] = (chunk_id,position)
+        self._next_chunk = chunk_ids[-1] + 1 if chunk_ids else 0
+
+    def __repr__(self):
+        return "<Archive: %s guids in %s chunks, %s bytes>"%(len(self),
+            len(self.chunks),self.nbytes)
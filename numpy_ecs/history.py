@@ -0,0 +1,178 @@
+'''
+A ring buffer of the last frames of chosen Components, for rollback.
+
+    history = allocator.enable_history(('position','velocity'),frames=8)
+    ...
+    allocator.record_frame() #once per frame, after the Systems ran
+    ...
+    allocator.rollback(3)    #back to the frame recorded 3 record_frames ago
+
+Each recorded Component gets one (frames, rows) array, allocated when
+history is enabled, and record_frame copies the used rows of each into the
+next slot.  Only the rows are copied each frame: the layout (Table rows and
+GuidPool) is snapshot the first time a frame is recorded after _defrag moved
+data, and every frame until the next move shares that snapshot.
+
+Rolling back to a frame with the current layout writes the recorded rows
+back.  Rolling back across a _defrag also restores the Table and GuidPool of
+that frame, so guids added since are gone and guids deleted since are alive
+again.  That needs the rows of every Component with data to be recorded,
+or the ones not recorded would be left in a layout they were not written
+for.  Pending adds, deletes and moves are dropped.
+
+SparseComponents and the pools of SharedComponents are not recorded (shared
+pools only grow, so recorded ids stay valid), nor is the hibernation Archive.
+Rollback invalidates the delta log and does not tell layout subscribers.
+
+This file is part of Numpy-ECS.
+Copyright (C) 2016 Elliot Hallmark (permafacture@gmail.com)
+
+Numpy-ECS is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 2 of the License, or
+(at your option) any later version.
+
+Data Oriented Python is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+from __future__ import absolute_import, division, print_function
+import sys
+#python version compatability
+if sys.version_info < (3,0):
+    from future_builtins import zip, map
+
+import numpy as np
+
+from .components import TagComponent
+from .persistence import table_blocks, restore_table, used_rows
+from .prefabs import row_shape
+
+class Layout(object):
+    '''the Table rows and GuidPool of a range of frames'''
+
+    def __init__(self,version,table,pool):
+        self.version = version #Table.version this was taken at
+        self.table = table #arrays of persistence.table_blocks
+        self.pool = pool #arrays of GuidPool.blocks, copied
+
+    @property
+    def nbytes(self):
+        return sum(array.nbytes for array in self.table + self.pool)
+
+class FrameHistory(object):
+    '''see module docstring.  rows is the rows each frame can hold of a
+    Component, by default its capacity.  A ring grows if a Component
+    outgrows it.'''
+
+    def __init__(self,allocator,names,frames,rows=None):
+        assert frames > 0, "history needs at least one frame"
+        components = allocator.component_dict
+        for name in names:
+            assert name in components, "%s is not a Component"%(name,)
+            assert not isinstance(components[name],TagComponent), \
+                "%s has no data to record"%(name,)
+        self.names = tuple(names)
+        self.frames = frames
+        self.columns = tuple(allocator.names.index(name) for name in names)
+        self.rings = {}
+        for name in names:
+            component = components[name]
+            size = max(component.capacity if rows is None else rows,1)
+            self.rings[name] = np.empty((frames,size)+row_shape(component),
+                                        dtype=component.datatype)
+        self.used = np.zeros((frames,len(names)),dtype=np.int64)
+        self.layouts = [None]*frames #shared by the frames of one layout
+        self.head = -1 #slot of the newest frame
+        self.count = 0 #frames recorded
+        self._layout = None #the newest Layout
+        #rolling back across a _defrag rewrites every Component with data
+        self.complete = set(names) >= {name for name in allocator.names
+                                       if not isinstance(components[name],TagComponent)}
+
+    def __len__(self):
+        return self.count
+
+    @property
+    def nbytes(self):
+        layouts = {id(layout):layout for layout in self.layouts if layout is not None}
+        return (sum(ring.nbytes for ring in self.rings.values()) + self.used.nbytes
+                + sum(layout.nbytes for layout in layouts.values()))
+
+    def _grow(self,name,size):
+        ring = self.rings[name]
+        grown = np.empty((self.frames,max(size,2*ring.shape[1]))+ring.shape[2:],
+                         dtype=ring.dtype)
+        grown[:,:ring.shape[1]] = ring
+        self.rings[name] = grown
+        return grown
+
+    def record(self,allocator):
+        '''copy the current frame into the ring, over the oldest if full.
+        Pending adds and deletes are applied first.'''
+        allocator._defrag()
+        table = allocator._allocation_table
+        layout = self._layout
+        if layout is None or layout.version != table.version:
+            pool = [np.array(array) for key, array in allocator.guid_pool.blocks()]
+            layout = Layout(table.version,
+                            [array for key, array in table_blocks(table)],pool)
+            self._layout = layout
+        slot = (self.head + 1) % self.frames
+        self.head = slot
+        self.count = min(self.count + 1,self.frames)
+        self.layouts[slot] = layout
+        used = used_rows(table)
+        components = allocator.component_dict
+        for j, (name, column) in enumerate(zip(self.names,self.columns)):
+            n = used[column]
+            ring = self.rings[name]
+            if n > ring.shape[1]:
+                ring = self._grow(name,n)
+            ring[slot,:n] = components[name][:n]
+            self.used[slot,j] = n
+
+    def rollback(self,allocator,k):
+        '''restore the frame recorded k record calls before the newest, and
+        forget the frames after it.  k of 0 undoes changes since the newest.'''
+        assert 0 <= k < self.count, "only %s frames are recorded"%(self.count,)
+        slot = (self.head - k) % self.frames
+        layout = self.layouts[slot]
+        table = allocator._allocation_table
+        pending = (allocator._cached_adds or allocator._cached_spawns or
+                   allocator._cached_moves or allocator._pending_removes)
+        components = allocator.component_dict
+        relayout = pending or layout.version != table.version
+        if relayout: #check before changing anything
+            assert self.complete, \
+                "rolling back across a _defrag needs every Component recorded"
+            archive = allocator.archive
+            assert not any(guid in archive for guid in layout.table[0].tolist()), \
+                "cannot roll back across hibernate"
+        allocator._bump_generation()
+        if relayout:
+            allocator._cached_adds = list()
+            allocator._cached_spawns = list()
+            allocator._cached_moves = dict()
+            allocator._pending_removes = {}
+            restore_table(table,*layout.table)
+            allocator.guid_pool.restore(*layout.pool)
+            layout.version = table.version #the frames sharing it match again
+            self._layout = layout
+            for name, n in zip(allocator.names,used_rows(table)):
+                components[name].assert_capacity(n)
+            allocator._delta_floor = allocator.generation #log is incomplete
+        for j, name in enumerate(self.names):
+            n = self.used[slot,j]
+            components[name].write_all(slice(0,n),self.rings[name][slot,:n])
+        self.head = slot
+        self.count -= k
+        allocator._layout_changed()
+
+    def __repr__(self):
+        return "<FrameHistory: %s of %s frames of %s>"%(self.count,self.frames,
+            ', '.join(self.names))
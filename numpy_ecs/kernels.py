@@ -0,0 +1,215 @@
+'''
+In place implementations of Systems that come up again and again.
+
+Every temporary lives in a Scratch, which keeps one buffer per (key, name)
+and only reallocates when the shape or dtype it is asked for changes.  Pass
+the query as the key so that Systems called on different sections do not
+fight over the same buffers.  Once the buffers exist, these kernels allocate
+no array data.
+
+This file is part of Numpy-ECS.
+Copyright (C) 2016 Elliot Hallmark (permafacture@gmail.com)
+
+Numpy-ECS is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 2 of the License, or
+(at your option) any later version.
+
+Data Oriented Python is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+from __future__ import absolute_import, division, print_function
+import sys
+#python version compatability
+if sys.version_info < (3,0):
+    from future_builtins import zip, map
+
+import numpy as np
+from math import cos, sin
+
+from .systems import prange
+
+class Scratch(object):
+    '''preallocated temporary arrays, keyed by (key, name)'''
+
+    def __init__(self):
+        self._buffers = {}
+
+    def get(self,key,name,shape,dtype):
+        '''an uninitialized array of shape and dtype that is reused by the
+        next call with the same key and name.  Asking for fewer rows
+        returns a view of the buffer, so tiles of varying length share it.'''
+        buf = self._buffers.get((key,name))
+        if (buf is None or buf.dtype != dtype or buf.shape[1:] != shape[1:]
+                or len(buf) < shape[0]):
+            buf = np.empty(shape,dtype=dtype)
+            self._buffers[(key,name)] = buf
+        return buf[:shape[0]]
+
+    def clear(self):
+        self._buffers = {}
+
+    @property
+    def nbytes(self):
+        return sum(buf.nbytes for buf in self._buffers.values())
+
+SCRATCH = Scratch() #used when a kernel is not given one
+
+def _as_intp(indices,key,scratch):
+    '''indices as intp without allocating. np.take would otherwise make an
+    intp copy of int32 indices on every call'''
+    if indices.dtype == np.intp:
+        return indices
+    buf = scratch.get(key,'indices',indices.shape,np.intp)
+    np.copyto(buf,indices,casting='safe')
+    return buf
+
+def wrap_counter(counter,key=None,scratch=SCRATCH):
+    '''advance counters with the structured dtype fields 'min_val',
+    'max_val', 'interval' and 'accumulator' by one interval, wrapping
+    accumulators that leave [min_val, max_val) back around by the span.
+
+    The same as update_rotator and update_animation in the examples.'''
+    acc = counter['accumulator']
+    low = counter['min_val']
+    high = counter['max_val']
+    span = scratch.get(key,'wrap_counter span',acc.shape,acc.dtype)
+    wrap = scratch.get(key,'wrap_counter mask',acc.shape,np.bool_)
+    np.subtract(high,low,out=span)
+    np.add(acc,counter['interval'],out=acc)
+    np.less_equal(acc,low,out=wrap)
+    np.add(acc,span,out=acc,where=wrap)
+    np.greater_equal(acc,high,out=wrap)
+    np.subtract(acc,span,out=acc,where=wrap)
+
+def broadcast_add(target,source,indices,key=None,scratch=SCRATCH):
+    '''target += source[indices], where indices broadcast rows of source
+    to rows of target, ie: from a 'position__to__render_verts' query'''
+    indices = _as_intp(indices,key,scratch)
+    #one column at a time: strided 2d operands would be buffered by numpy
+    assert target.ndim in (1,2), "broadcast_add is for 1 or 2d components"
+    targets = (target[:,None] if target.ndim == 1 else target).T
+    sources = (source[:,None] if source.ndim == 1 else source).T
+    gathered = scratch.get(key,'broadcast_add',(len(target),),target.dtype)
+    for t, s in zip(targets,sources):
+        np.take(s,indices,out=gathered,mode='clip')
+        np.add(t,gathered,out=t)
+
+def take_rows(source,indices,key=None,scratch=SCRATCH):
+    '''source[indices] in a scratch buffer, ie: the rows of a SharedComponent's
+    pool for each row of T, from a 'name__to__T' query'''
+    indices = _as_intp(indices,key,scratch)
+    out = scratch.get(key,'take_rows',(len(indices),)+source.shape[1:],
+                      source.dtype)
+    return np.take(source,indices,axis=0,out=out,mode='clip')
+
+def rotate_verts(render_verts,poly_verts,positions,angles,indices,
+                 key=None,scratch=SCRATCH):
+    '''Set the x and y of render_verts to poly_verts rotated by angles and
+    translated by positions.  poly_verts rows are (x,y,r,cos(alpha),
+    sin(alpha)) as made by wind_vertices in the examples, and angles and
+    positions have one row per entity which indices broadcasts to the rows
+    of render_verts.
+
+    The same sum-difference formula as update_render_verts in the
+    examples.'''
+    dtype = render_verts.dtype
+    n, m = len(render_verts), len(angles)
+    cos_ts = scratch.get(key,'rotate_verts cos',(m,),dtype)
+    sin_ts = scratch.get(key,'rotate_verts sin',(m,),dtype)
+    cos_rows = scratch.get(key,'rotate_verts cos rows',(n,),dtype)
+    sin_rows = scratch.get(key,'rotate_verts sin rows',(n,),dtype)
+    tmp = scratch.get(key,'rotate_verts tmp',(n,),dtype)
+
+    indices = _as_intp(indices,key,scratch)
+    np.cos(angles,out=cos_ts)
+    cos_ts -= 1
+    np.sin(angles,out=sin_ts)
+    np.take(cos_ts,indices,out=cos_rows,mode='clip')
+    np.take(sin_ts,indices,out=sin_rows,mode='clip')
+    xs, ys, rs, xhelpers, yhelpers = (poly_verts[:,x] for x in range(5))
+    x = render_verts[:,0]
+    y = render_verts[:,1]
+
+    np.multiply(xhelpers,cos_rows,out=x)
+    np.multiply(yhelpers,sin_rows,out=tmp)
+    x -= tmp
+    x *= rs
+    x += xs
+    np.take(positions[:,0],indices,out=tmp,mode='clip')
+    x += tmp
+
+    np.multiply(yhelpers,cos_rows,out=y)
+    np.multiply(xhelpers,sin_rows,out=tmp)
+    y += tmp
+    y *= rs
+    y += ys
+    np.take(positions[:,1],indices,out=tmp,mode='clip')
+    y += tmp
+
+def fused_rotate_verts(render_verts,poly_verts,positions,angles,indices):
+    '''rotate_verts as one loop over rows, for System(jit=True).  Compiled,
+    it is a single parallel pass with no temporaries.  As plain python it
+    is very slow.'''
+    for i in prange(len(render_verts)):
+        j = indices[i]
+        c = cos(angles[j]) - 1
+        s = sin(angles[j])
+        r = poly_verts[i,2]
+        xhelper = poly_verts[i,3]
+        yhelper = poly_verts[i,4]
+        render_verts[i,0] = (xhelper*c - yhelper*s)*r + poly_verts[i,0] + positions[j,0]
+        render_verts[i,1] = (yhelper*c + xhelper*s)*r + poly_verts[i,1] + positions[j,1]
+
+if __name__ == '__main__':
+    #compare with the implementations in the examples
+    counter_type = np.dtype([('max_val',    np.float32),
+                             ('min_val',    np.float32),
+                             ('interval',   np.float32),
+                             ('accumulator',np.float32)])
+    counter = np.zeros(5,dtype=counter_type)
+    counter['max_val'] = 1
+    counter['min_val'] = -1
+    counter['interval'] = (.3,-.3,.7,-.7,0)
+    expected = counter.copy()
+    for frame in range(10):
+        arr = expected
+        span = arr['max_val'] - arr['min_val']
+        arr['accumulator'] += arr['interval']
+        underflow = arr['accumulator'] <= arr['min_val']
+        arr['accumulator'][underflow] += span[underflow]
+        overflow = arr['accumulator'] >= arr['max_val']
+        arr['accumulator'][overflow] -= span[overflow]
+        wrap_counter(counter,key='test')
+    assert np.allclose(counter['accumulator'],expected['accumulator'])
+
+    np.random.seed(0)
+    indices = np.repeat(np.arange(3,dtype=np.int32),(4,5,6))
+    poly_verts = np.random.random((15,5)).astype(np.float32)
+    positions = np.random.random((3,3)).astype(np.float32)
+    angles = counter['accumulator'][:3]
+    render_verts = np.zeros((15,3),dtype=np.float32)
+    rotate_verts(render_verts,poly_verts,positions,angles,indices,key='test')
+
+    cos_ts, sin_ts = np.cos(angles)-1, np.sin(angles)
+    xs, ys, rs, xhelpers, yhelpers = (poly_verts[:,x] for x in range(5))
+    x = (xhelpers*cos_ts[indices] - yhelpers*sin_ts[indices])*rs + xs
+    y = (yhelpers*cos_ts[indices] + xhelpers*sin_ts[indices])*rs + ys
+    assert np.allclose(render_verts[:,0],x + positions[indices,0],atol=1e-6)
+    assert np.allclose(render_verts[:,1],y + positions[indices,1],atol=1e-6)
+
+    fused = np.zeros_like(render_verts)
+    fused_rotate_verts(fused,poly_verts,positions,angles,indices)
+    assert np.allclose(fused[:,:2],render_verts[:,:2],atol=1e-6)
+
+    pool, rows = poly_verts[:5], np.tile(np.arange(5,dtype=np.int32),3)
+    assert np.all(take_rows(pool,rows,key='test') == pool[rows])
+
+    before = render_verts.copy()
+    broadcast_add(render_verts[:,:2],positions[:,:2],indices,key='test')
+    assert np.allclose(render_verts[:,:2],before[:,:2]+positions[indices,:2])
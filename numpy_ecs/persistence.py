@@ -0,0 +1,395 @@
+'''
+Saving and loading a GlobalAllocator to a single binary file.
+
+The file is a small JSON header followed by raw, aligned numpy blocks:
+
+  MAGIC | header length (uint32) | header (json) | block | block | ...
+
+Every Component contributes one block holding only its used rows, and the
+Table contributes blocks of guids, class indices and sizes.  Blocks are
+aligned so that they can be memory mapped in place, which lets a large world
+open without reading its Component data until it is touched.  The Table is
+still rebuilt as python rows on load, in bulk from its blocks, which takes
+time in proportion to the number of entities (around half a second for
+100,000).
+
+This file is part of Numpy-ECS.
+Copyright (C) 2016 Elliot Hallmark (permafacture@gmail.com)
+
+Numpy-ECS is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 2 of the License, or
+(at your option) any later version.
+
+Data Oriented Python is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+from __future__ import absolute_import, division, print_function
+import sys
+#python version compatability
+if sys.version_info < (3,0):
+    from future_builtins import zip, map
+
+import ast
+import json
+import struct
+from collections import OrderedDict
+import numpy as np
+
+from .table import rows_from_array
+from .components import DefraggingArrayComponent, SharedComponent, TagComponent
+from .sparse import SparseComponent
+
+MAGIC = b'\x93NPECS\x01\x00'
+ALIGNMENT = 64 #bytes. Blocks start on multiples of this
+# 1: components and Table.  Component headers may lack track_dirty and
+#    double_buffered, and there is no guid pool; it is rebuilt on load
+# 2: adds the guid pool
+# 3: adds shared, tag and sparse components, dormant classes and the archive
+FORMAT_VERSION = 3
+READABLE_VERSIONS = (1,2,3)
+
+def _aligned(n, alignment=ALIGNMENT):
+    return (n + alignment - 1) // alignment * alignment
+
+def dtype_to_str(dtype):
+    '''a string that dtype_from_str can turn back into dtype'''
+    return repr(np.lib.format.dtype_to_descr(np.dtype(dtype)))
+
+def dtype_from_str(string):
+    return np.dtype(ast.literal_eval(string))
+
+def _pack_header(header, blocks):
+    '''returns (header bytes, [(offset, array),...], end) where header bytes
+    is padded so that the first block is aligned.  Offsets are absolute.'''
+    layout = {}
+    offset = 0
+    placed = []
+    for key, array in blocks:
+        array = np.ascontiguousarray(array)
+        layout[key] = {'offset': offset,
+                       'shape' : list(array.shape),
+                       'dtype' : dtype_to_str(array.dtype)}
+        placed.append((offset, array))
+        offset = _aligned(offset + array.nbytes)
+    header = dict(header, blocks=layout, version=FORMAT_VERSION)
+    raw = json.dumps(header, sort_keys=True).encode('utf-8')
+    data_start = _aligned(len(MAGIC) + 4 + len(raw))
+    raw += b' ' * (data_start - len(MAGIC) - 4 - len(raw))
+    return raw, [(data_start + o, a) for o, a in placed], data_start + offset
+
+def write_blocks(fileobj, header, blocks):
+    '''write the json-able dict `header` and the sequence of (key, ndarray)
+    `blocks` to the binary file object `fileobj`'''
+    raw, placed, end = _pack_header(header, blocks)
+    fileobj.write(MAGIC)
+    fileobj.write(struct.pack('<I', len(raw)))
+    fileobj.write(raw)
+    position = len(MAGIC) + 4 + len(raw)
+    for offset, array in placed:
+        fileobj.write(b'\0' * (offset - position))
+        fileobj.write(array.tobytes())
+        position = offset + array.nbytes
+    fileobj.write(b'\0' * (end - position))
+
+def dumps_blocks(header, blocks):
+    '''same as write_blocks, but returns bytes'''
+    from io import BytesIO
+    buf = BytesIO()
+    write_blocks(buf, header, blocks)
+    return buf.getvalue()
+
+def _parse_header(prefix):
+    assert prefix[:len(MAGIC)] == MAGIC, 'not a Numpy-ECS file'
+    start = len(MAGIC) + 4
+    length, = struct.unpack('<I', prefix[len(MAGIC):start])
+    header = json.loads(prefix[start:start + length].decode('utf-8'))
+    assert header['version'] in READABLE_VERSIONS, \
+        'unsupported format version %s' % (header['version'],)
+    header['data_start'] = start + length
+    return header
+
+def read_header(path):
+    '''returns the header dict of the file at path'''
+    with open(path, 'rb') as f:
+        prefix = f.read(len(MAGIC) + 4)
+        length, = struct.unpack('<I', prefix[len(MAGIC):])
+        return _parse_header(prefix + f.read(length))
+
+def map_block(path, header, key, mode='c'):
+    '''memory map block `key` of the file at `path`.  mode is as for
+    numpy.memmap; the default 'c' is copy on write so the file is never
+    modified.'''
+    info = header['blocks'][key]
+    shape = tuple(info['shape'])
+    dtype = dtype_from_str(info['dtype'])
+    if 0 in shape:
+        #cannot mmap zero bytes
+        return np.empty(shape, dtype=dtype)
+    return np.memmap(path, dtype=dtype, mode=mode, shape=shape,
+                     offset=header['data_start'] + info['offset'])
+
+def loads_blocks(data):
+    '''inverse of dumps_blocks. returns (header, {key: array,...}) where the
+    arrays are read only views of data'''
+    header = _parse_header(data)
+    arrays = {}
+    for key, info in header['blocks'].items():
+        dtype = dtype_from_str(info['dtype'])
+        shape = tuple(info['shape'])
+        count = int(np.prod(shape)) if shape else 1
+        arrays[key] = np.frombuffer(data, dtype=dtype, count=count,
+            offset=header['data_start'] + info['offset']).reshape(shape)
+    return header, arrays
+
+#########
+#
+#  GlobalAllocator snapshots
+#
+#########
+
+def component_header(component):
+    header = {'name'       : component.name,
+              'dim'        : list(component._dim),
+              'dtype'      : dtype_to_str(component.datatype),
+              'track_dirty': component.track_dirty,
+              'double_buffered': component.double_buffered}
+    if isinstance(component, TagComponent):
+        header['tag'] = True
+    if isinstance(component, SharedComponent):
+        header['pool'] = {'dim'  : list(component.pool._dim),
+                          'dtype': dtype_to_str(component.pool.datatype)}
+    return header
+
+def component_from_header(info):
+    if info.get('tag'):
+        return TagComponent(info['name'])
+    if 'pool' in info:
+        return SharedComponent(info['name'], tuple(info['pool']['dim']),
+                               dtype_from_str(info['pool']['dtype']),
+                               track_dirty=info.get('track_dirty', False),
+                               double_buffered=info.get('double_buffered', False))
+    return DefraggingArrayComponent(info['name'], tuple(info['dim']),
+                                    dtype_from_str(info['dtype']),
+                                    track_dirty=info.get('track_dirty', False),
+                                    double_buffered=info.get('double_buffered', False))
+
+def _outside_table(allocator):
+    '''allocator's storage that is not laid out by the Table'''
+    shared = [allocator.component_dict[name] for name in allocator.names
+              if isinstance(allocator.component_dict[name], SharedComponent)]
+    return shared + sorted(allocator.sparse_dict.values(), key=lambda c: c.name)
+
+def extra_blocks(allocator):
+    '''the pools of SharedComponents and the sets of SparseComponents as
+    blocks.  They are always sent whole: pools hold one copy of each
+    distinct value and sparse sets are small.'''
+    blocks = []
+    for component in _outside_table(allocator):
+        blocks.extend(component.blocks())
+    return blocks
+
+def restore_extra(allocator, get_block):
+    '''inverse of extra_blocks'''
+    for component in _outside_table(allocator):
+        component.restore(*(np.array(get_block(key)) for key, _ in
+                            component.blocks()))
+
+TABLE_BLOCKS = ('table/guids', 'table/class_index', 'table/sizes')
+
+def table_blocks(table, guids=None):
+    '''compact array representation of the Table's guid rows.  guids 
+    replaces table.guids if given.'''
+    known = table.known_class_ids
+    n_cols = len(table.column_names)
+    guids = np.array(table.guids if guids is None else guids, dtype=np.int64)
+    class_index = np.array([known.index(c) for c in table.class_ids],
+                           dtype=np.int32)
+    sizes = np.array([tuple(row) for row in table.sizes],
+                     dtype=np.int64).reshape(-1, n_cols)
+    return list(zip(TABLE_BLOCKS, (guids, class_index, sizes)))
+
+def restore_table(table, guids, class_index, sizes):
+    '''overwrite table's guid rows with the arrays made by table_blocks'''
+    known = table.known_class_ids
+    table.guids = guids.tolist()
+    table.class_ids = list(map(known.__getitem__, class_index.tolist()))
+    table.sizes = rows_from_array(sizes)
+    table.starts = table.make_starts_table(sizes)
+    table._staged_adds = {}
+    table._staged_guids = set()
+    table._index = None
+    table.version += 1
+
+def used_rows(table):
+    '''the number of rows each column of table uses'''
+    if table.starts:
+        return tuple(table.starts[-1])
+    return (0,) * len(table.column_names)
+
+def save_allocator(allocator, path):
+    '''write allocator to path.  Pending adds and deletes are applied first
+    so that every component is stored as one contiguous used region.'''
+    allocator._defrag()
+    table = allocator._allocation_table
+    used = used_rows(table)
+    components = [allocator.component_dict[name] for name in allocator.names]
+    blocks = table_blocks(table) + allocator.guid_pool.blocks()
+    blocks += extra_blocks(allocator) + allocator.archive.blocks()
+    blocks.extend(('component/' + c.name, c[:n]) for c, n in zip(components, used))
+    header = {'components'       : [component_header(c) for c in components],
+              'sparse_components': [component_header(c.values) for c in
+                                    allocator.sparse_dict.values()],
+              'allocation_scheme': [list(c) for c in table.active_class_ids]}
+    with open(path, 'wb') as f:
+        write_blocks(f, header, blocks)
+
+def load_allocator(cls, path, mode='c'):
+    '''create an instance of GlobalAllocator subclass cls from the file at
+    path.  Component data is memory mapped (see map_block for mode) and only
+    paged in as it is used.  A component is copied into memory the first time
+    it needs to grow.'''
+    header = read_header(path)
+    components = [component_from_header(info) for info in header['components']]
+    scheme = tuple(tuple(c) for c in header['allocation_scheme'])
+    sparse = [SparseComponent(info['name'], tuple(info['dim']),
+                              dtype_from_str(info['dtype']))
+              for info in header.get('sparse_components', ())]
+    allocator = cls(components, scheme, sparse_components=sparse)
+    for component in components:
+        data = map_block(path, header, 'component/' + component.name, mode)
+        component.set_buffer(data)
+    restore_table(allocator._allocation_table,
+                  *(map_block(path, header, key, 'r') for key in TABLE_BLOCKS))
+    restore_guid_pool(allocator, header['blocks'],
+                      lambda key: map_block(path, header, key, 'r'))
+    restore_extra(allocator, lambda key: map_block(path, header, key, 'r'))
+    allocator.archive.restore(header['blocks'],
+                              lambda key: map_block(path, header, key, 'r'))
+    return allocator
+
+POOL_BLOCKS = ('guids/generations', 'guids/states', 'guids/free', 'guids/pending')
+
+def restore_guid_pool(allocator, keys, get_block):
+    '''restore allocator's GuidPool from blocks, or rebuild it from the
+    Table's guids if there are none (format version 1)'''
+    pool = allocator.guid_pool
+    if POOL_BLOCKS[0] in keys:
+        pool.restore(*(np.array(get_block(key)) for key in POOL_BLOCKS))
+    else:
+        pool.rebuild(g for g in allocator._allocation_table.guids if g is not None)
+
+#########
+#
+#  Deltas between allocators
+#
+#########
+
+def _collapse_log(entries):
+    '''merge delta log entries into (removed guids,
+    [(guid,(sizes,dormant)),...]).
+    Guids added and then removed inside entries appear in neither.  Replaying
+    the result as one compress gives the same layout as the entries did,
+    because compress keeps survivors in order and appends adds in order.'''
+    removed = set()
+    added = OrderedDict()
+    for generation, removes, adds in entries:
+        for guid in removes:
+            if guid in added:
+                del added[guid]
+            else:
+                removed.add(guid)
+        for guid, sizes, dormant in adds:
+            added[guid] = (sizes, dormant)
+    return sorted(removed), list(added.items())
+
+def _defragged_guids(allocator):
+    '''table guids as of the last _defrag (pending deletes undone)'''
+    guids = list(allocator._allocation_table.guids)
+    for row, guid in allocator._pending_removes.items():
+        guids[row] = guid
+    return guids
+
+def make_delta(allocator, generation):
+    '''see GlobalAllocator.delta_since'''
+    table = allocator._allocation_table
+    n_cols = len(table.column_names)
+    used = used_rows(table)
+    full = generation <= allocator._delta_floor
+    if full:
+        blocks = table_blocks(table, _defragged_guids(allocator))
+        blocks += allocator.guid_pool.blocks()
+    else:
+        log = [e for e in allocator._delta_log if e[0] >= generation]
+        removed, added = _collapse_log(log)
+        blocks = [('removed', np.array(removed, dtype=np.int64)),
+                  ('added/guids', np.array([g for g, _ in added], dtype=np.int64)),
+                  ('added/sizes', np.array([s for _, (s, d) in added],
+                                           dtype=np.int64).reshape(-1, n_cols)),
+                  ('added/dormant', np.array([d for _, (s, d) in added],
+                                             dtype=np.bool_))]
+    blocks += extra_blocks(allocator)
+    for name, n in zip(allocator.names, used):
+        component = allocator.component_dict[name]
+        if component.track_dirty and not full:
+            ranges = component.changed_since(generation, n)
+        else:
+            ranges = [(0, n)] if n else []
+        data = [component[start:stop] for start, stop in ranges]
+        blocks.append(('ranges/' + name,
+                       np.array(ranges, dtype=np.int64).reshape(-1, 2)))
+        blocks.append(('data/' + name,
+                       np.concatenate(data) if data else component[0:0]))
+    header = {'since'     : generation,
+              'generation': allocator.generation,
+              'full'      : full}
+    allocator._bump_generation() #later writes are newer than this delta
+    return dumps_blocks(header, blocks)
+
+def replay_delta(allocator, delta):
+    '''see GlobalAllocator.apply_delta'''
+    header, arrays = loads_blocks(delta)
+    table = allocator._allocation_table
+    pool = allocator.guid_pool
+    allocator._bump_generation()
+    restore_extra(allocator, arrays.get)
+    if header['full']:
+        restore_table(table, *(arrays[key] for key in TABLE_BLOCKS))
+        restore_guid_pool(allocator, arrays, arrays.get)
+        for name, n in zip(allocator.names, used_rows(table)):
+            allocator.component_dict[name].assert_capacity(n)
+    else:
+        added = arrays['added/guids'].tolist()
+        dormant = arrays['added/dormant'].tolist() if 'added/dormant' in \
+            arrays else [False] * len(added)
+        moved = set(added) #removed and added again, ie: deactivated
+        carried = [] #their rows move with them, as on the source
+        for guid in arrays['removed'].tolist():
+            if guid in moved:
+                carried.append((table.index_of(guid), guid,
+                                tuple(table.slices_from_guid(guid))))
+            table.stage_delete(guid)
+            #a full delta sends pending deletes released
+            if guid not in moved and pool.is_alive(guid):
+                pool.release(guid)
+        for guid, sizes, asleep in zip(added, arrays['added/sizes'].tolist(),
+                                       dormant):
+            table.stage_add(guid, tuple(sizes), asleep)
+            if not pool.is_alive(guid):
+                pool.claim(guid)
+        allocator._apply_compress([(guid, old) for row, guid, old
+                                   in sorted(carried)])
+    for name in allocator.names:
+        component = allocator.component_dict[name]
+        data = arrays['data/' + name]
+        offset = 0
+        for start, stop in arrays['ranges/' + name].tolist():
+            component[start:stop] = data[offset:offset + stop - start]
+            offset += stop - start
+    allocator._delta_floor = allocator.generation #own log is incomplete
+    allocator._layout_changed()
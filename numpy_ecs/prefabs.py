@@ -0,0 +1,94 @@
+'''
+Prefabs are entity templates whose component values are converted once and
+then stamped out many times:
+
+    allocator.register_prefab('enemy', {'poly_verts': wind_vertices(pts),
+                                        'render_verts': [(0,0,0)]*n,
+                                        'position': (0,0,0)})
+    guids = allocator.spawn('enemy', 1000,
+                            overrides={'position': positions})
+
+Spawned instances are staged together and all land in one contiguous run of
+rows, so _defrag writes each Component of the batch with a single assignment.
+
+This file is part of Numpy-ECS.
+Copyright (C) 2016 Elliot Hallmark (permafacture@gmail.com)
+
+Numpy-ECS is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 2 of the License, or
+(at your option) any later version.
+
+Data Oriented Python is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+from __future__ import absolute_import, division, print_function
+import sys
+#python version compatability
+if sys.version_info < (3,0):
+    from future_builtins import zip, map
+
+import numpy as np
+
+def rows_in_value(value):
+    '''number of Component rows an added value fills'''
+    if value is None:
+        return 0
+    shape = value.shape
+    if len(shape) > 1:
+        #TODO only supports arrays like [n] and [1,n] !!!
+        #TODO Can't think of fix or what one would be expecting but I
+        #TODO must note this limitation
+        return shape[0]
+    else:
+        return 1
+
+def row_shape(component):
+    '''shape of one row of component as numpy sees it'''
+    return () if component._dim == (1,) else component._dim
+
+class Prefab(object):
+    '''converted component values of one entity, and its row sizes'''
+
+    def __init__(self,name,arrays,components,column_names):
+        self.name = name
+        self.arrays = {}
+        for key, value in arrays.items():
+            shape = (rows_in_value(value),) + row_shape(components[key])
+            assert value.size == int(np.prod(shape)), \
+                "prefab '%s' cannot tile %s of shape %s"%(name,key,value.shape)
+            self.arrays[key] = value.reshape(shape)
+        self.sizes = tuple(len(self.arrays[c]) if c in self.arrays else 0
+                           for c in column_names)
+
+    def __repr__(self):
+        return "<Prefab %s: %s>"%(self.name,', '.join(sorted(self.arrays)))
+
+class SpawnBatch(object):
+    '''n instances of a Prefab staged by spawn'''
+
+    def __init__(self,prefab,guids,overrides):
+        self.prefab = prefab
+        self.guids = guids
+        self.overrides = overrides #{name: per instance or per row array}
+
+    def __len__(self):
+        return len(self.guids)
+
+    def data(self,name):
+        '''the rows of Component name for every instance, in order'''
+        template = self.prefab.arrays[name]
+        n, k = len(self.guids), len(template)
+        value = self.overrides.get(name)
+        if value is None:
+            return np.tile(template,(n,)+(1,)*(template.ndim-1))
+        if len(value) == n*k:
+            return value
+        assert len(value) == n, \
+            "override of %s needs %s or %s rows"%(name,n,n*k)
+        return np.repeat(value,k,axis=0)
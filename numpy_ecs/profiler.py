@@ -0,0 +1,124 @@
+'''
+A frame profiler that keeps the most recent spans in a ring buffer and writes
+them as Chrome trace JSON, which chrome://tracing and ui.perfetto.dev open.
+
+    profiler = allocator.enable_profiler()
+    ...
+    def on_draw():
+        profiler.next_frame()
+        ...
+    profiler.dump('frames.json')
+
+While enabled, the allocator records a span for every _defrag and each of its
+phases (see numpy_ecs.stats), every query (with whether it hit the cache) and
+every System called on it.  next_frame marks where frames start, so that a
+stuttering frame shows up as one wide 'frame' span.  Spans of your own can be
+added with `with profiler.span(name):`.
+
+This file is part of Numpy-ECS.
+Copyright (C) 2016 Elliot Hallmark (permafacture@gmail.com)
+
+Numpy-ECS is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 2 of the License, or
+(at your option) any later version.
+
+Data Oriented Python is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+from __future__ import absolute_import, division, print_function
+import sys
+#python version compatability
+if sys.version_info < (3,0):
+    from future_builtins import zip, map
+
+import os
+import json
+import threading
+from collections import deque, namedtuple
+from contextlib import contextmanager
+
+from .stats import clock
+
+# start and stop are seconds from clock().  args is a dict or None
+Span = namedtuple('Span',('name','category','start','stop','frame','thread','args'))
+
+class FrameProfiler(object):
+    '''see module docstring'''
+
+    def __init__(self,capacity=65536):
+        self.spans = deque(maxlen=capacity)
+        self.frame = 0
+        self._frame_start = None
+        self._defrag = None
+
+    def record(self,name,category,start,stop,args=None):
+        self.spans.append(Span(name,category,start,stop,self.frame,
+                               threading.current_thread().ident,args))
+
+    @contextmanager
+    def span(self,name,category='user',args=None):
+        start = clock()
+        try:
+            yield
+        finally:
+            self.record(name,category,start,clock(),args)
+
+    def next_frame(self):
+        '''end the current frame and start the next'''
+        now = clock()
+        if self._frame_start is not None:
+            self.record('frame','frame',self._frame_start,now)
+        self.frame += 1
+        self._frame_start = now
+
+    def clear(self):
+        self.spans.clear()
+
+    #the probe interface.  see GlobalAllocator._probes
+
+    def begin(self,generation):
+        self._defrag = (clock(),generation)
+
+    def phase(self,phase,start,stop):
+        self.record(phase,'defrag',start,stop)
+
+    def moved(self,component,sources,resized):
+        pass
+
+    def end(self):
+        start, generation = self._defrag
+        self.record('_defrag','defrag',start,clock(),{'generation':generation})
+        self._defrag = None
+
+    def query(self,query,hit,start,stop):
+        self.record('query','query',start,stop,
+                    {'query':' '.join(query),'cached':hit})
+
+    #export
+
+    def chrome_trace(self):
+        '''the spans as a Chrome trace event dict'''
+        pid = os.getpid()
+        events = []
+        for span in self.spans:
+            event = {'name': span.name,
+                     'cat' : span.category,
+                     'ph'  : 'X',
+                     'ts'  : span.start*1e6,
+                     'dur' : (span.stop - span.start)*1e6,
+                     'pid' : pid,
+                     'tid' : span.thread,
+                     'args': dict(span.args or {},frame=span.frame)}
+            events.append(event)
+        return {'traceEvents':events,'displayTimeUnit':'ms'}
+
+    def dump(self,path):
+        '''write chrome_trace() to path'''
+        with open(path,'w') as f:
+            json.dump(self.chrome_trace(),f)
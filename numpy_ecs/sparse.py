@@ -0,0 +1,199 @@
+'''
+Sparse set storage for Components that few entities have.
+
+Every optional Component in the allocation scheme doubles the classes that
+may exist and splits the sections systems stream over.  A SparseComponent
+is instead kept outside the Table, as a sparse set:
+
+    values[:len(c)] - one row per entity that has it, packed densely
+    guids[:len(c)]  - the guid each of those rows belongs to
+    sparse          - the dense row of each guid index, or -1
+
+so adding or removing one is O(1) and never moves Table rows.  Give them to
+the allocator with GlobalAllocator(..., sparse_components=(burning,)).  A
+query names them like any Component:
+
+    sections = allocator.selectors_from_component_query(
+        ('position','burning','burning__to__position'))
+
+where sections['burning'] is the dense values and 'burning__to__position'
+gives, for each row of position's section, the row of burning's values that
+goes with it or -1.  See join.
+
+This file is part of Numpy-ECS.
+Copyright (C) 2016 Elliot Hallmark (permafacture@gmail.com)
+
+Numpy-ECS is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 2 of the License, or
+(at your option) any later version.
+
+Data Oriented Python is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+from __future__ import absolute_import, division, print_function
+import sys
+#python version compatability
+if sys.version_info < (3,0):
+    from future_builtins import zip, map
+
+import numpy as np
+
+from .components import DefraggingArrayComponent
+from .guids import index_of
+
+class SparseComponent(object):
+    '''see module docstring.  An entity has at most one row of each.'''
+
+    def __init__(self,name,dim,dtype):
+        self.name = name
+        self.values = DefraggingArrayComponent(name,dim,dtype)
+        self.guids = np.zeros(0,dtype=np.int64) #grown with values
+        self.sparse = np.zeros(0,dtype=np.int32) #{guid index: row}, -1 if none
+        self.count = 0
+
+    @property
+    def datatype(self):
+        return self.values.datatype
+
+    @property
+    def _dim(self):
+        return self.values._dim
+
+    def _row(self,guid):
+        index = index_of(guid)
+        if index >= len(self.sparse):
+            return -1
+        row = self.sparse[index]
+        if row < 0 or self.guids[row] != guid: #stale generation
+            return -1
+        return int(row)
+
+    def __contains__(self,guid):
+        return self._row(guid) >= 0
+
+    def __len__(self):
+        return self.count
+
+    def get(self,guid):
+        '''guid's row of values'''
+        row = self._row(guid)
+        assert row >= 0, "guid %s has no %s"%(guid,self.name)
+        return self.values[row]
+
+    def insert(self,guid,value):
+        '''give guid value, replacing any it had'''
+        row = self._row(guid)
+        if row < 0:
+            row = self.count
+            self.values.assert_capacity(row + 1)
+            if len(self.guids) <= row:
+                guids = np.zeros(len(self.values[:]),dtype=np.int64)
+                guids[:row] = self.guids[:row]
+                self.guids = guids
+            index = index_of(guid)
+            if index >= len(self.sparse):
+                sparse = np.full(max(index + 1,2*len(self.sparse)),-1,
+                                 dtype=np.int32)
+                sparse[:len(self.sparse)] = self.sparse
+                self.sparse = sparse
+            self.guids[row] = guid
+            self.sparse[index] = row
+            self.count += 1
+        self.values[row] = value
+
+    def remove(self,guid):
+        '''take guid's value away.  The last row fills its place.  returns
+        False if guid had none.'''
+        row = self._row(guid)
+        if row < 0:
+            return False
+        last = self.count - 1
+        if row != last:
+            self.values.realloc(slice(last,last+1),slice(row,row+1))
+            self.guids[row] = self.guids[last]
+            self.sparse[index_of(self.guids[row])] = row
+        self.sparse[index_of(guid)] = -1
+        self.count = last
+        return True
+
+    def remove_many(self,guids):
+        '''remove for every guid of an int64 array at once.  Rows from the
+        end fill the holes left below the new count.  returns how many
+        guids had a value.'''
+        rows = self.join(guids)
+        rows = np.unique(rows[rows >= 0])
+        if not len(rows):
+            return 0
+        count = self.count - len(rows)
+        self.sparse[index_of(self.guids[rows])] = -1
+        holes = rows[rows < count]
+        tail = np.ones(self.count - count,dtype=bool)
+        tail[rows[rows >= count] - count] = False
+        fillers = np.flatnonzero(tail) + count #survivors past the new count
+        if len(holes):
+            self.values.realloc(fillers,holes)
+            self.guids[holes] = self.guids[fillers]
+            self.sparse[index_of(self.guids[holes])] = holes
+        self.count = count
+        return len(rows)
+
+    def join(self,guids):
+        '''the row of values of each of guids (an int64 array, like a
+        'guid__to__T' index), or -1 for guids without one.  Deleted guids
+        (-1) have none.'''
+        guids = np.asarray(guids,dtype=np.int64)
+        indices = index_of(guids)
+        valid = (guids >= 0) & (indices < len(self.sparse))
+        rows = np.full(len(guids),-1,dtype=np.int32)
+        candidates = self.sparse[indices[valid]]
+        found = candidates >= 0
+        found[found] = self.guids[candidates[found]] == guids[valid][found]
+        rows[np.flatnonzero(valid)[found]] = candidates[found]
+        return rows
+
+    def blocks(self):
+        '''[(key, array),...] for persistence.write_blocks'''
+        prefix = 'sparse/' + self.name
+        return [(prefix + '/guids',self.guids[:self.count]),
+                (prefix + '/values',self.values[:self.count])]
+
+    def restore(self,guids,values):
+        '''inverse of blocks'''
+        self.__init__(self.name,self.values._dim,self.values.datatype)
+        for guid, value in zip(guids.tolist(),values):
+            self.insert(guid,value)
+
+    def __repr__(self):
+        return "<SparseComponent: %s, %s rows>"%(self.name,self.count)
+
+if __name__ == '__main__':
+    from .guids import make_guid
+    burning = SparseComponent('burning',(1,),np.float32)
+    a, b, c = make_guid(0,1), make_guid(5,1), make_guid(2,1)
+    burning.insert(a,1.)
+    burning.insert(b,2.)
+    burning.insert(c,3.)
+    burning.insert(b,4.)
+    assert len(burning) == 3 and burning.get(b) == 4.
+    assert burning.remove(a) and not burning.remove(a)
+    assert a not in burning and burning.get(c) == 3.
+    assert make_guid(5,2) not in burning, 'stale generations are not found'
+    rows = burning.join([c,-1,a,b,make_guid(5,2),make_guid(99,1)])
+    assert rows.tolist() == [0,-1,-1,1,-1,-1], "c filled the row a left"
+    restored = SparseComponent('burning',(1,),np.float32)
+    restored.restore(*(array for key, array in burning.blocks()))
+    assert restored.join([b,c]).tolist() == [1,0] and restored.get(c) == 3.
+    many = SparseComponent('many',(1,),np.int32)
+    guids = [make_guid(i,1) for i in range(8)]
+    for value, guid in enumerate(guids):
+        many.insert(guid,value)
+    assert many.remove_many([guids[1],guids[6],guids[2],make_guid(9,1)]) == 3
+    assert len(many) == 5 and not any(g in many for g in guids[1:3] + guids[6:7])
+    assert sorted(many.get(g) for g in guids if g in many) == [0,3,4,5,7]
+    assert sorted(many.values[:5].tolist()) == [0,3,4,5,7], "survivors are packed"
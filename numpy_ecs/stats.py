@@ -0,0 +1,134 @@
+'''
+Optional instrumentation of a GlobalAllocator.
+
+    stats = allocator.enable_stats()
+    ...
+    print(stats.report(allocator))
+
+While enabled, every _defrag records the time spent in each phase:
+
+  stage    - staging cached adds in the Table
+  compress - planning the new layout (Table.compress)
+  move     - resizing Components and moving their rows
+  add      - writing the values of cached adds
+
+along with the bytes moved and resizes of each Component.  The last `history`
+_defrags are kept in stats.history so that a spiking frame can be found, and
+totals are kept since the last reset.  Query cache hits and misses are
+counted too.  Disabled (the default), the allocator only checks that it
+has no probes (AllocatorStats and FrameProfiler are its probes).
+
+This file is part of Numpy-ECS.
+Copyright (C) 2016 Elliot Hallmark (permafacture@gmail.com)
+
+Numpy-ECS is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 2 of the License, or
+(at your option) any later version.
+
+Data Oriented Python is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+from __future__ import absolute_import, division, print_function
+import sys
+#python version compatability
+if sys.version_info < (3,0):
+    from future_builtins import zip, map
+
+import time
+from collections import deque
+
+import numpy as np
+
+clock = getattr(time,'perf_counter',time.time)
+
+PHASES = ('stage','compress','move','add')
+
+def lap(probes,phase,start):
+    '''tell every probe that phase ran from start until now.  returns now'''
+    now = clock()
+    for probe in probes:
+        probe.phase(phase,start,now)
+    return now
+
+def row_nbytes(component):
+    '''bytes in one row of component'''
+    return np.dtype(component.datatype).itemsize * int(np.prod(component._dim))
+
+class AllocatorStats(object):
+    '''see module docstring'''
+
+    def __init__(self,history=256):
+        self.history = deque(maxlen=history)
+        self.reset()
+
+    def reset(self):
+        self.defrags = 0
+        self.seconds = dict.fromkeys(PHASES,0.)
+        self.bytes_moved = {} #{component name: bytes}
+        self.resizes = {} #{component name: count}
+        self.query_hits = 0
+        self.query_misses = 0
+        self.history.clear()
+        self._current = None
+
+    #the probe interface.  see GlobalAllocator._probes
+
+    def begin(self,generation):
+        '''start recording a _defrag'''
+        record = dict.fromkeys(PHASES,0.)
+        record.update(generation=generation,bytes_moved=0,resizes=0)
+        self._current = record
+
+    def phase(self,phase,start,stop):
+        '''count the time from start to stop toward phase'''
+        self.seconds[phase] += stop - start
+        if self._current is not None:
+            self._current[phase] += stop - start
+
+    def moved(self,component,sources,resized):
+        '''count the rows moved by realloc(source,...) for each of sources,
+        and a resize if resized'''
+        name = component.name
+        rows = sum(s.stop - s.start for s in sources)
+        nbytes = rows * row_nbytes(component)
+        self.bytes_moved[name] = self.bytes_moved.get(name,0) + nbytes
+        if resized:
+            self.resizes[name] = self.resizes.get(name,0) + 1
+        if self._current is not None:
+            self._current['bytes_moved'] += nbytes
+            self._current['resizes'] += bool(resized)
+
+    def end(self):
+        '''finish recording a _defrag'''
+        self.defrags += 1
+        self.history.append(self._current)
+        self._current = None
+
+    def query(self,query,hit,start,stop):
+        if hit:
+            self.query_hits += 1
+        else:
+            self.query_misses += 1
+
+    def slowest(self,n=1):
+        '''the n _defrags in history that took longest'''
+        return sorted(self.history,
+                      key=lambda r: -sum(r[phase] for phase in PHASES))[:n]
+
+    def report(self,allocator=None):
+        '''a dict of the totals, with allocator's entity counts if given'''
+        report = {'defrags'     : self.defrags,
+                  'seconds'     : dict(self.seconds),
+                  'bytes_moved' : dict(self.bytes_moved),
+                  'resizes'     : dict(self.resizes),
+                  'query_hits'  : self.query_hits,
+                  'query_misses': self.query_misses}
+        if allocator is not None:
+            report['entities'] = allocator.entity_counts()
+        return report
@@ -0,0 +1,271 @@
+'''
+Systems bound to the Components they read and write.
+
+    @system(writes=('position',), reads=('velocity',))
+    def apply_velocity(positions, velocities, dt=1./600):
+        positions += velocities*dt
+
+    apply_velocity(allocator, 1./60)
+
+calls the function with the sections of the written Components followed by
+the sections of the read ones (which may include index and offset names like
+'position__to__poly_verts'), then any extra arguments.  Written sections are
+marked dirty.
+
+With tile=True (or a number of rows), a NumPy System is called once per tile
+of its sections instead of once on the whole of them.  Tiles hold whole
+entities and are about TILE_BYTES of the query's widest Component, so a chain
+of in place operations stays in cache between passes.  Index and offset
+arrays are rebased to each tile, and the pools of SharedComponents are
+passed whole to every tile.  Systems that reduce or look across
+entities must not be tiled.
+
+With jit=True the function is compiled by numba.njit when Numba is installed,
+so a System written as one loop over rows (use `prange` from this module for
+the outer loop) runs as a single fused, multithreaded pass with no
+temporaries.  Without Numba, `fallback` is called instead if given, or else
+the function runs as plain python.
+
+This file is part of Numpy-ECS.
+Copyright (C) 2016 Elliot Hallmark (permafacture@gmail.com)
+
+Numpy-ECS is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 2 of the License, or
+(at your option) any later version.
+
+Data Oriented Python is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+from __future__ import absolute_import, division, print_function
+import sys
+#python version compatability
+if sys.version_info < (3,0):
+    from future_builtins import zip, map
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+import numpy as np
+
+if numba is not None:
+    prange = numba.prange
+elif sys.version_info < (3,0):
+    prange = xrange
+else:
+    prange = range
+
+from .table import INDEX_SEPERATOR, GUID_COLUMN, OFFSETS_SUFFIX
+from .components import SharedComponent
+from .stats import clock
+
+HAVE_NUMBA = numba is not None
+TILE_BYTES = 256*1024 #roughly the size of L2
+
+def compile_loop(function,parallel=True):
+    '''function compiled by numba.njit, or None without Numba'''
+    if numba is None:
+        return None
+    return numba.njit(parallel=parallel,cache=False)(function)
+
+class System(object):
+    '''A function and the query that gives its arguments.  See system.'''
+
+    def __init__(self,function,reads=(),writes=(),jit=False,parallel=True,
+                 fallback=None,tile=False):
+        self.py_func = function
+        self.reads = tuple(reads)
+        self.writes = tuple(writes)
+        self.query = self.writes + self.reads
+        assert len(set(self.query)) == len(self.query), \
+            'a Component may only be read or written once'
+        compiled = compile_loop(function,parallel) if jit else None
+        self.jitted = compiled is not None
+        if compiled is not None:
+            self.function = compiled
+        elif fallback is not None:
+            self.function = fallback
+        else:
+            self.function = function
+        self.__name__ = function.__name__
+        self.__doc__ = function.__doc__
+        self.tile = tile
+        if tile:
+            from .kernels import Scratch
+            self.scratch = Scratch()
+            columns = [n for n in self.query if not
+                       (INDEX_SEPERATOR in n or n.endswith(OFFSETS_SUFFIX))]
+            self._columns = columns
+            self._tile_query = self.query + tuple(n + OFFSETS_SUFFIX for n in
+                columns if n + OFFSETS_SUFFIX not in self.query)
+            for name in self.query:
+                if INDEX_SEPERATOR in name:
+                    assert name.split(INDEX_SEPERATOR)[1] in columns, \
+                        'tiling %s needs its target in the query' % (name,)
+                elif name.endswith(OFFSETS_SUFFIX):
+                    assert name[:-len(OFFSETS_SUFFIX)] in columns, \
+                        'tiling %s needs its Component in the query' % (name,)
+
+    def sections(self,allocator):
+        '''the arguments this System is called with from allocator'''
+        sections = allocator.selectors_from_component_query(self.query,
+                                                            writes=self.writes)
+        return [sections[name] for name in self.query]
+
+    def __call__(self,allocator,*args):
+        profiler = allocator.profiler
+        if profiler is not None:
+            start = clock()
+        if self.tile:
+            for sections in self.tiles(allocator):
+                self.function(*(sections + list(args)))
+            result = None
+        else:
+            result = self.function(*(self.sections(allocator) + list(args)))
+        if profiler is not None:
+            profiler.record(self.__name__,'system',start,clock())
+        return result
+
+    def tiles(self,allocator):
+        '''yield the arguments of each tile (see the module docstring)'''
+        sections = allocator.selectors_from_component_query(self._tile_query,
+                                                            writes=self.writes)
+        #the pools of SharedComponents are passed whole to every tile
+        shared = {name for name in self._columns if
+                  isinstance(allocator.component_dict[name],SharedComponent)}
+        columns = [name for name in self._columns if name not in shared]
+        assert columns, 'tiling needs a Component that is not shared'
+        n_guids = len(sections[columns[0] + OFFSETS_SUFFIX])
+        #row where each guid starts, with the end of the section appended
+        bounds = {name:np.append(sections[name + OFFSETS_SUFFIX],
+                                 len(sections[name])) for name in columns}
+        widest = max(columns, key=lambda name: sections[name][:1].nbytes)
+        if self.tile is True:
+            row_bytes = max(sections[widest][:1].nbytes,1)
+            tile_rows = max(TILE_BYTES // row_bytes,1)
+        else:
+            tile_rows = self.tile
+        starts = np.unique(np.searchsorted(bounds[widest][:-1],
+            np.arange(0,max(len(sections[widest]),1),tile_rows),'right') - 1)
+        starts = np.maximum(starts,0).tolist()
+        for first, last in zip(starts, starts[1:] + [n_guids]):
+            if first == last:
+                continue
+            yield [self._tile_of(name,sections,bounds,shared,first,last)
+                   for name in self.query]
+
+    def _tile_of(self,name,sections,bounds,shared,first,last):
+        '''name's argument for the guids first to last'''
+        if name in shared:
+            return sections[name]
+        if INDEX_SEPERATOR in name:
+            source, target = name.split(INDEX_SEPERATOR)
+            rows = bounds[target]
+            values = sections[name][rows[first]:rows[last]]
+            if source == GUID_COLUMN or source in shared:
+                return values #guids and pool rows need no rebasing
+            out = self.scratch.get(self,name,values.shape,values.dtype)
+            return np.subtract(values,first,out=out)
+        if name.endswith(OFFSETS_SUFFIX):
+            rows = bounds[name[:-len(OFFSETS_SUFFIX)]]
+            out = self.scratch.get(self,name,(last-first,),rows.dtype)
+            return np.subtract(rows[first:last],rows[first],out=out)
+        rows = bounds[name]
+        return sections[name][rows[first]:rows[last]]
+
+    def __repr__(self):
+        return "<System %s writes=%s reads=%s%s>"%(self.__name__,
+            self.writes,self.reads,' (jit)' if self.jitted else '')
+
+def system(reads=(),writes=(),jit=False,parallel=True,fallback=None,
+           tile=False):
+    '''decorator making a System of a function.  See the module docstring.'''
+    def decorator(function):
+        return System(function,reads,writes,jit,parallel,fallback,tile)
+    return decorator
+
+if __name__ == '__main__':
+    from numpy_ecs.components import DefraggingArrayComponent as Component
+    from numpy_ecs.global_allocator import GlobalAllocator
+    from numpy_ecs.kernels import rotate_verts, fused_rotate_verts
+
+    position = Component('position',(3,),np.float32)
+    angle    = Component('angle',(1,),np.float32)
+    poly     = Component('poly_verts',(5,),np.float32)
+    verts    = Component('render_verts',(3,),np.float32)
+    allocator = GlobalAllocator([position,angle,poly,verts],((1,1,1,1),(1,0,0,0)))
+    np.random.seed(0)
+    for n in (3,4,5):
+        allocator.add({'position':np.random.random(3),
+                       'angle':np.random.random(),
+                       'poly_verts':np.random.random((n,5)),
+                       'render_verts':np.zeros((n,3))})
+    allocator.add({'position':(1,2,3)})
+    allocator._defrag()
+
+    update_render_verts = system(writes=('render_verts',),
+        reads=('poly_verts','position','angle','position__to__poly_verts'),
+        jit=True, fallback=rotate_verts)(fused_rotate_verts)
+    assert update_render_verts.jitted == HAVE_NUMBA
+    update_render_verts(allocator)
+
+    sections = update_render_verts.sections(allocator)
+    result = sections[0].copy()
+    sections[0][:] = 0
+    fused_rotate_verts(*sections)
+    assert np.allclose(sections[0],result,atol=1e-5)
+
+    @system(writes=('position',),reads=('angle',))
+    def spin(positions,angles,dt):
+        positions[:,2] += angles*dt
+    positions, angles = spin.sections(allocator)
+    before = positions.copy()
+    spin(allocator,2.)
+    assert np.allclose(positions[:,2] - before[:,2], 2*angles)
+
+    #tiles hold whole entities and give the same result as one call
+    result = sections[0].copy()
+    query = ('render_verts','poly_verts','position','angle')
+    index = ('position__to__poly_verts','guid__to__poly_verts',
+             'poly_verts__offsets')
+    calls = []
+    def update_tiled(render_verts,poly_verts,positions,angles,indices,
+                     guids,offsets):
+        calls.append(len(positions))
+        assert len(offsets) == len(positions) and offsets[0] == 0
+        assert len(guids) == len(render_verts) and indices[0] == 0
+        rotate_verts(render_verts,poly_verts,positions,angles,indices)
+    for tile, expected in ((1,[1,1,1]),(6,[1,2]),(7,[2,1]),(True,[3])):
+        sections[0][:] = 0
+        tiled = system(writes=query[:1],reads=query[1:]+index,tile=tile)(update_tiled)
+        del calls[:]
+        tiled(allocator)
+        assert np.allclose(sections[0],result,atol=1e-5)
+        assert calls == expected, (tile, calls)
+
+    #shared pools are passed whole to each tile, with pool rows as they are
+    from numpy_ecs.components import SharedComponent
+    mesh = SharedComponent('mesh',(2,),np.float32)
+    verts = Component('verts',(2,),np.float32)
+    shared = GlobalAllocator([mesh,verts],((1,1),))
+    for shape in ((0,1),(2,3),(0,1)):
+        shared.add({'mesh':np.reshape(shape,(-1,2)),'verts':np.zeros((1,2))})
+    shared._defrag()
+    @system(writes=('verts',),reads=('mesh','mesh__to__verts'),tile=1)
+    def copy_mesh(verts,pool,rows):
+        assert len(pool) == 2
+        verts[:] = pool[rows]
+    copy_mesh(shared)
+    assert verts[:3].tolist() == [[0,1],[2,3],[0,1]]
+
+    #calls are profiled
+    profiler = allocator.enable_profiler()
+    spin(allocator,0.)
+    assert [s.name for s in profiler.spans if s.category == 'system'] == ['spin']
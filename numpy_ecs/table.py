@@ -33,10 +33,20 @@ You should have received a copy of the GNU General Public License
 along with this program.  If not, see <http://www.gnu.org/licenses/>.
 '''
 
+import sys
 from collections import MutableMapping, Sequence
 from types import GeneratorType
+import numpy as np
+from .guids import INDEX_MASK
 
 INDEX_SEPERATOR = '__to__' # 'ie: index from component1__to__component2
+GUID_COLUMN = 'guid' # 'ie: guid__to__component1 gives the guid of each row
+OFFSETS_SUFFIX = '__offsets' # 'ie: component1__offsets starts of guids' rows
+DORMANT = 2 # in a class id, a Component of a dormant entity.  ie: (2,0,2)
+
+def dormant_class_id(class_id):
+    '''the class id of the dormant section of class_id'''
+    return tuple(DORMANT if x else 0 for x in class_id)
 
 #TODO make row a numpy array and delete TableRow
 class TableRow(Sequence):
@@ -80,6 +90,15 @@ class TableRow(Sequence):
     def __getitem__(self,index):
         return self.values[index]
 
+def rows_from_array(array):
+    '''a list of TableRows of the rows of a 2d int array'''
+    new = TableRow.__new__
+    def make_row(values):
+        row = new(TableRow)
+        row.values = values
+        return row
+    return list(map(make_row,map(tuple,array.tolist())))
+
 def slice_is_not_empty(s):
     #print "  ",s.start,s.stop-s.start
     return s.start != s.stop
@@ -99,16 +118,28 @@ class Table(object):
         '''column names is a tuple of strings that define, in order, the names
         of the columns present in this table.  class_ids is a tuple of tuples
         that determines the order of the major rows (essential for keeping 
-        related arrays contiguous with respect to each other)'''
+        related arrays contiguous with respect to each other).
+
+        Every class also gets a dormant section, after all of the active
+        ones, for entities that queries should skip.  See stage_add.'''
+        assert GUID_COLUMN not in column_names, \
+            "'%s' is reserved and cannot be a column name" % (GUID_COLUMN,)
         self.__col_names = tuple(column_names)
         self.__row_length = len(column_names)
         self.__row_format = ''.join((" | {:>%s}"%(len(name)) for name in column_names))
         self._staged_adds = dict()
-        self.known_class_ids = tuple(class_ids)
+        self._staged_guids = set()
+        self.active_class_ids = tuple(class_ids)
+        self.known_class_ids = self.active_class_ids + \
+            tuple(dormant_class_id(c) for c in class_ids)
         self.class_ids = list()
         self.guids = list()
         self.starts = list()
         self.sizes = list()
+        #row of each guid by the guid's index (see guids.py), -1 for none.
+        # built when needed
+        self._index = None
+        self.version = 0 #counts compresses and restores of the rows
 
     @property
     def column_names(self):
@@ -147,30 +178,86 @@ class Table(object):
     #    #    enumerate(sizes_tuple[::-1])))
     #    return tuple(0 if x==0 else x/x for x in sizes_tuple)
 
-    def stage_add(self,guid,value_tuple):
-        assert guid not in self.guids, "guid must be unique"
-        assert guid not in {t[0] for lst in self._staged_adds.values() \
-            for t in lst}, "cannot restage a staged guid"
+    def stage_add(self,guid,value_tuple,dormant=False):
+        '''stage guid with the sizes in value_tuple.  If dormant, it goes in
+        the dormant section of its class.'''
+        assert self._row_of(guid) < 0, "guid must be unique"
+        assert guid not in self._staged_guids, "cannot restage a staged guid"
         ent_class = self.entity_class_from_tuple(value_tuple)
-        assert ent_class in self.known_class_ids, \
+        assert ent_class in self.active_class_ids, \
             "added entity must corispond to a class id in the allocation schema"
+        if dormant:
+            ent_class = dormant_class_id(ent_class)
         #print "guid %s is class %s"%(guid,ent_class)
         self._staged_adds.setdefault(ent_class,
             list()).append((guid,value_tuple))
+        self._staged_guids.add(guid)
+
+    def is_dormant(self,row):
+        return DORMANT in self.class_ids[row]
+
+    def _build_index(self):
+        guids = self.guids
+        if None in guids:
+            guids = [-1 if g is None else g for g in guids]
+        guids = np.array(guids,dtype=np.int64).reshape(-1)
+        rows = np.flatnonzero(guids >= 0)
+        slots = guids[rows] & INDEX_MASK
+        index = np.full(int(slots.max()) + 1 if len(slots) else 0,-1,dtype=np.int32)
+        index[slots] = rows
+        self._index = index
+
+    def _row_of(self,guid):
+        '''the row guid is in, or -1.  The guid found at the row of its
+        index must be guid itself, or it is another generation.'''
+        if self._index is None:
+            self._build_index()
+        index = self._index
+        slot = guid & INDEX_MASK
+        if slot < len(index):
+            row = index.item(slot)
+            if row >= 0 and self.guids[row] == guid:
+                return row
+        return -1
+
+    def index_of(self,guid):
+        '''the row guid is in'''
+        row = self._row_of(guid)
+        if row < 0:
+            raise ValueError("guid %s is not in table" % (guid,))
+        return row
 
     def stage_delete(self,guid):
         '''mark guid None so it can be removed later'''
-        self.guids[self.guids.index(guid)] = None
-
-    def make_starts_table(self):
+        row = self.index_of(guid)
+        self.guids[row] = None
+        self._index[guid & INDEX_MASK] = -1
+
+    def stage_delete_rows(self,rows):
+        '''mark the guids in rows (an array or iterable of row indices) None
+        so they can be removed later, all at once.  returns (rows, guids) as
+        int64 arrays, for the rows that were not already deleted'''
+        rows = np.unique(np.asarray(rows,dtype=np.int64))
+        column = np.array(self.guids,dtype=object)
+        found = column[rows]
+        live = np.not_equal(found,None)
+        rows = rows[live]
+        column[rows] = None
+        self.guids[:] = column.tolist() #others may hold the list
+        guids = found[live].astype(np.int64)
+        if self._index is not None:
+            self._index[guids & INDEX_MASK] = -1
+        return rows, guids
+
+    def make_starts_table(self,sizes=None):
         '''Create a list of tuples where each value is the start index of that
-        element. (Table is the sizes)'''
-        start = TableRow(*(0,)*self.__row_length)
-        table = [start]
-        for row in self.sizes:
-          start = row + start
-          table.append(start)
-        return table
+        element. (Table is the sizes, or the 2d array sizes if given)'''
+        if sizes is None:
+            sizes = np.array([row.values for row in self.sizes],dtype=np.int64)
+        sizes = sizes.reshape(-1,self.__row_length)
+        starts = np.zeros((len(sizes)+1,self.__row_length),dtype=np.int64)
+        np.cumsum(sizes,axis=0,out=starts[1:])
+        return rows_from_array(starts)
 
     #def class_sizes_table(self):
     #    '''return a list of rows where each row is the size of the class_id's 
@@ -209,6 +296,44 @@ class Table(object):
         ret_val = {class_id:slice(start,stop,1) for class_id,start,stop in \
             zip(expressed_ids,starts,stops)}
         return ret_val
+
+    def section_sizes(self):
+        '''returns {class_id: (rows of column 1, rows of column 2, ...)} of
+        the sections of every class id present, tombstones included'''
+        starts = self.starts
+        result = {}
+        for class_id, section in self.section_slices().items():
+            stop = len(self.guids) if section.stop is None else section.stop
+            result[class_id] = tuple(b - a for a,b in
+                                     zip(starts[section.start],starts[stop]))
+        return result
+
+    def python_nbytes(self,sample=None):
+        '''estimate of the bytes held by the python lists and objects of this
+        table.  If sample is given, only that many evenly spaced rows are
+        measured and the total is extrapolated.'''
+        getsizeof = sys.getsizeof
+        def row_nbytes(row):
+            if isinstance(row,TableRow):
+                return (getsizeof(row) + getsizeof(row.__dict__)
+                        + getsizeof(row.values)
+                        + sum(getsizeof(v) for v in row.values))
+            return getsizeof(row)
+        columns = (self.guids,self.class_ids,self.sizes,self.starts)
+        total = sum(getsizeof(column) for column in columns)
+        if self._index is not None:
+            total += getsizeof(self._index)
+        n = len(self.starts)
+        rows = range(n) if sample is None or sample >= n else \
+            sorted(set(np.linspace(0,n-1,max(sample,1)).astype(int).tolist()))
+        measured = 0
+        for i in rows:
+            measured += row_nbytes(self.starts[i])
+            if i < len(self.guids):
+                measured += row_nbytes(self.guids[i]) + row_nbytes(self.sizes[i])
+        if rows:
+            total += measured * n // len(rows)
+        return total
  
     def guid_slices(self,guid):
         '''returns a dictionary of {component: slice object,} representing
@@ -224,12 +349,14 @@ class Table(object):
         '''
         container::class_ids - must be contiguous
 
-        returns ((start,), (row1,row2, ...)) - tuple of starts of section and
-            then all the rows within the section
+        returns ((start,), (row1,row2, ...), first) - tuple of starts of 
+            section, then all the rows within the section, and then the
+            index of the section's first row in this table
         '''
         result = []
+        first = 0
         starts  = TableRow(*(0,)*self.__row_length) 
-        started = self.class_ids[0] in class_ids
+        started = bool(self.class_ids) and self.class_ids[0] in class_ids
         all_ids = iter(self.class_ids)
         for class_id, size_row in zip(all_ids,self.sizes):
              if started == True:
@@ -243,18 +370,47 @@ class Table(object):
                      started = True
                  else:
                    starts = starts+size_row
+                   first += 1
         assert not any(_id in class_ids for _id in all_ids), \
             "given set of class_ids must be contigious"
 
-        return starts,result
+        return starts,result,first
+
+    def matched_class_ids(self, col_names):
+        '''the set of active class ids that have all of col_names'''
+        names = self.__col_names
+        mask_tuple = tuple(1 if n in col_names else 0 for n in names)
+        def in_mask(item_tuple,mask=mask_tuple):
+            return (x for x,m in zip(item_tuple,mask) if m)
 
-    def mask_slices(self, col_names, indices):
+        known_ids = self.active_class_ids #ordered for contiguity
+        return {class_id for class_id in known_ids if all(in_mask(class_id))}
+
+    def section_rows(self, col_names):
+        '''returns (first, stop) the range of rows in this table (not in the
+        columns) of the guids that have all of col_names'''
+        n = len(self.guids)
+        sections = self.section_slices()
+        present = [sections[c] for c in self.matched_class_ids(col_names)
+                   if c in sections]
+        if not present:
+            return n, n
+        return (min(s.start for s in present),
+                max(n if s.stop is None else s.stop for s in present))
+
+    def mask_slices(self, col_names, indices, offsets=()):
         '''
         (string,)::col_names - to use as a mask.
         (string,)::indices - form of  S+INDEX_SEPERATOR+T. S broadcasting to T
-          (sizes in S must *always* be 1)
+          (sizes in S must *always* be 1).  If S is GUID_COLUMN, the index
+          holds the guid owning each row of T (-1 for deleted guids).
+        (string,)::offsets - form of T+OFFSETS_SUFFIX.  The start of each
+          guid's rows of T, relative to the start of T's slice.  For reducing
+          rows to one value per guid with ufunc.reduceat (guids with no rows
+          of T make reduceat return the next row instead of an identity).
 
-        returns {name1:slice1, ..., index1:index_array1,...}.
+        returns {name1:slice1, ...}, {index1:index_array1, ...}.  Indices
+        from S are int32, guids are int64 and offsets are int32
 
         enforces that columns are contiguous.'''
 
@@ -263,32 +419,47 @@ class Table(object):
         def to_indices(string, c_names = names, 
                     sep = INDEX_SEPERATOR):
             p1,p2 = string.split(sep)
-            assert (p1 in c_names), '%s must be a column_name'%p1
+            assert (p1 in c_names or p1 == GUID_COLUMN), '%s must be a column_name'%p1
             assert (p2 in c_names), '%s must be a column_name'%p2
+            if p1 == GUID_COLUMN:
+                return None, c_names.index(p2)
             return c_names.index(p1), c_names.index(p2)
 
-        mask_tuple = tuple(1 if n in col_names else 0 for n in names)
-        def in_mask(item_tuple,mask=mask_tuple):
-            return (x for x,m in zip(item_tuple,mask) if m)
+        def to_offsets(string, c_names = names, suffix = OFFSETS_SUFFIX):
+            name = string[:-len(suffix)]
+            assert string.endswith(suffix) and name in c_names, \
+                '%s must be a column_name followed by %s'%(string,suffix)
+            return c_names.index(name)
 
-        known_ids = self.known_class_ids #ordered for contiguity
-        matched_ids = {class_id for class_id in known_ids if all(in_mask(class_id))}
+        matched_ids = self.matched_class_ids(col_names)
         idxs = tuple(map(to_indices,indices))
 
-        sizes  = TableRow(*(0,)*self.__row_length)
-        idx_result = tuple(list() for x in range(len(idxs)))
-
-        starts,rows = self.rows_from_class_ids(matched_ids)
-        for i,row in enumerate(rows):
-            sizes += row 
-            for lst, (s,t) in zip (idx_result, idxs):
-                assert row[s] == 1, 'must broadcast from size == 1'
-                lst.extend([i]*row[t])
+        starts,rows,first = self.rows_from_class_ids(matched_ids)
+        size_array = np.array([tuple(row) for row in rows],
+                              dtype=np.int64).reshape(-1,self.__row_length)
+        sizes = size_array.sum(axis=0).tolist()
+
+        index_arrays = {}
+        for name, (s,t) in zip(indices,idxs):
+            if s is None:
+                guids = self.guids[first:first+len(rows)]
+                if None in guids:
+                    values = np.array(guids,dtype=object)
+                    values[np.equal(values,None)] = -1
+                    values = values.astype(np.int64)
+                else:
+                    values = np.array(guids,dtype=np.int64)
+            else:
+                assert np.all(size_array[:,s] == 1), 'must broadcast from size == 1'
+                values = np.arange(len(rows),dtype=np.int32)
+            index_arrays[name] = np.repeat(values,size_array[:,t])
+        for name in offsets:
+            counts = size_array[:,to_offsets(name)]
+            index_arrays[name] = (np.cumsum(counts) - counts).astype(np.int32)
 
         selectors = {n:slice(st,st+si) for n, st, si in zip(names,starts,sizes)\
                     if n in col_names}
-        indices = {n:lst for n,lst in zip(indices,idx_result)}
-        return selectors,indices
+        return selectors,index_arrays
 
     #def build_index(self,mask,index2single, index2multi):
     #    '''return a list of indices to broadcast an array of single values
@@ -331,6 +502,9 @@ class Table(object):
         #TODO could this be reduce?
         ends = TableRow(sum(column) for column in zip(*sizes)) or empty_row() 
         new_ends = ends.copy()
+        #a class's adds shift the later classes up before their deletes
+        # shift them back, so the moves may need more rows than the result
+        peak_ends = list(ends)
 
         #TODO section_slices should return [(class_id, section_slice),...]
         section_dict = self.section_slices()
@@ -392,6 +566,7 @@ class Table(object):
             #print "starts: %s | %s" % (current_start - free_start, ends - new_ends)
             current_start = free_start.copy() #TODO part of last debugging
             ends = new_ends.copy()
+            peak_ends = [max(p,e) for p,e in zip(peak_ends,new_ends)]
             total_alloc += allocs
             this_class_id = class_id
 
@@ -400,12 +575,15 @@ class Table(object):
         self.sizes = new_sizes
         self.starts = self.make_starts_table()
         self._staged_adds = {} 
+        self._staged_guids = set()
+        self._index = None
+        self.version += 1
 
         #columnize the row data
         #TODO make this a generator?
         ret = []
         for new_capacity, col_sources, col_targets in zip(
-                new_ends, zip(*sources), zip(*targets)):
+                peak_ends, zip(*sources), zip(*targets)):
             #print "sources:"
             col_sources = tuple((s for s in col_sources if slice_is_not_empty(s)))
             #print "targets:"
@@ -421,7 +599,7 @@ class Table(object):
         return ret
 
     def slices_from_guid(self,guid):
-        idx = self.guids.index(guid)
+        idx = self.index_of(guid)
         starts = self.starts[idx]
         sizes = self.sizes[idx]
         return (slice(start,start+size,1) for start,size in zip(starts,sizes))
@@ -593,3 +771,51 @@ if __name__ == '__main__':
     expected = {(1,0):slice(0,5,1),(1,1):slice(5,11,1),(0,1):slice(11,None,1)}
     assert t.section_slices()==expected, "section_slices should return expected result"
     assert t.mask_slices(('one','two'),())[0] == {'one':slice(15, 33, None), 'two':slice(0, 18, None)}
+    t.stage_delete(14)
+    assert list(t.mask_slices(('two',),('guid__to__two',))[1]['guid__to__two']) == \
+        [13]*3+[-1]*3+[15]*3+[16]*3+[17]*3+[18]*3+[1]*3+[2]*3+[3]*3+[4]*3+[5]*3
+    assert list(t.mask_slices(('one',),(),('two__offsets',))[1]['two__offsets']) == \
+        [0]*5 + [0,3,6,9,12,15]
+
+    #test dormant sections are laid out after every active one, and skipped
+    t = Table(('one','two'),((1,0),(1,1)))
+    for guid in range(4):
+      t.stage_add(guid,(1,1),dormant=guid%2)
+    t.stage_add(4,(1,0))
+    t.compress()
+    assert t.class_ids == [(1,0),(1,1),(1,1),(2,2),(2,2)]
+    assert t.guids == [4,0,2,1,3] and t.is_dormant(3) and not t.is_dormant(1)
+    assert t.mask_slices(('one',),())[0] == {'one':slice(0,3)}
+    assert t.mask_slices(('two',),())[0] == {'two':slice(0,2)}
+    #an add to an early class and deletes from a later one need room for
+    # the later class to shift up before it shifts back
+    t = Table(('one',),((1,),))
+    for guid in range(4):
+      t.stage_add(guid,(1,),dormant=guid>0)
+    t.compress()
+    t.stage_delete(2)
+    t.stage_delete(3)
+    t.stage_add(4,(1,))
+    (capacity, sources, targets), = t.compress()
+    assert sources == (slice(1,4,1),) and targets == (slice(2,5,1),)
+    assert capacity == 5
+
+    #test lookups find rows by guid index and check the generation
+    from .guids import make_guid
+    t = Table(('one',),((1,),))
+    old, new = make_guid(3,1), make_guid(3,2)
+    t.stage_add(old,(1,))
+    t.stage_add(make_guid(0,1),(2,))
+    t.compress()
+    assert t.index_of(old) == 0 and t._index.tolist() == [1,-1,-1,0]
+    for guid in (new,make_guid(9,1)):
+      try:
+        t.index_of(guid)
+      except ValueError:
+        pass
+      else:
+        raise AssertionError("found a guid that is not in the table")
+    t.stage_delete(old)
+    t.stage_add(new,(1,))
+    t.compress()
+    assert t.index_of(new) == 1 and t._row_of(old) == -1
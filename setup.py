@@ -10,5 +10,5 @@ setup(
     keywords = "data oriented programming, ECS",
     url = "https://github.com/Permafacture/data-oriented-pyglet",
     install_requires = ['numpy','pyglet'],
-    packages=['numpy_ecs',],
+    packages=['numpy_ecs','numpy_ecs.bench'],
 )